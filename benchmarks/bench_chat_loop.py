@@ -0,0 +1,263 @@
+# End-to-end benchmark of the chat loop in main.main(), run offline against
+# the local OpenAI stand-in in benchmarks/fake_openai.py.
+#
+#   python benchmarks/bench_chat_loop.py --turns 10 --tokens-per-second 200
+#
+# Each turn submits a chat input through streamlit's AppTest, so the real
+# streaming, rendering and function-call handling in main.py run. Turns whose
+# prompt mentions "franchise" go through the function-call path and a local
+# agent that answers after --agent-seconds. Postgres is replaced by a fixed
+# system prompt and an in-memory conversation store, so no backend but the
+# stand-in is needed.
+#
+# Needs streamlit>=1.28 for streamlit.testing. Without the tiktoken
+# cl100k_base encoding in TIKTOKEN_CACHE_DIR, tokens are counted as bytes,
+# which makes context windows and token counts about 4x too large.
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_openai import start_server, api_base  # noqa: E402
+
+PROMPTS = [
+    "Hi, I'm thinking about buying a business.",
+    "I have about 200k to invest and 10 years in retail management.",
+    "What is the initial investment for the Cookie Cutters franchise?",
+    "I'd prefer something I can run semi-absentee.",
+    "How do the royalty fees compare between both franchise options?",
+]
+
+
+class BenchAgent:
+    # Stands in for the QA agent so the function-call path runs end to end
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.tools = []
+
+    def run(self, inquiry, callbacks=None):
+        time.sleep(self.seconds)
+        return f"Local answer to: {inquiry}"
+
+
+def install_offline_connections():
+    # main.py only needs the system prompt from Postgres
+    connections = types.ModuleType("connections")
+    connections.fetch_versioned_system_prompt = lambda wait=True: (
+        "1",
+        "You are Jordan, a franchise consultant.",
+    )
+    connections.upload_prompt = lambda file_content: None
+    sys.modules["connections"] = connections
+
+
+class MemoryConversationStore:
+    def __init__(self):
+        self.messages = {}
+
+    def append(self, conversation_id, position, message):
+        self.messages.setdefault(conversation_id, {})[position] = message
+
+    def load(self, conversation_id):
+        messages = self.messages.get(conversation_id, {})
+        return [messages[position] for position in sorted(messages)]
+
+
+def install_offline_history():
+    import history_handlers
+
+    store = MemoryConversationStore()
+    history_handlers.get_conversation_store = lambda: store
+
+
+def install_offline_encoding():
+    # Returns the encoding's name, falling back to one token per byte when
+    # cl100k_base isn't cached and can't be downloaded
+    import tiktoken
+
+    try:
+        tiktoken.get_encoding("cl100k_base")
+        return "cl100k_base"
+    except Exception:
+        pass
+    encoding = tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([byte]): byte for byte in range(256)},
+        special_tokens={"<|endoftext|>": 256},
+    )
+    tiktoken.get_encoding = lambda name: encoding
+    tiktoken.encoding_for_model = lambda model: encoding
+    return "bytes"
+
+
+def run_turns(args, trace_allocations):
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(REPO_DIR, "main.py"), default_timeout=120)
+    app.secrets["chat"] = {"hedge_requests": args.hedge}
+    app.run()
+    if args.agent_seconds >= 0:
+        app.session_state["agent"] = BenchAgent(args.agent_seconds)
+        app.session_state["agent_namespaces"] = ["Cookie Cutters"]
+
+    results = []
+    for turn in range(args.turns):
+        prompt = PROMPTS[turn % len(PROMPTS)]
+        app.session_state["stream_stats"] = None
+        if trace_allocations:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        started = time.perf_counter()
+        app.chat_input[0].set_value(prompt).run()
+        turn_seconds = time.perf_counter() - started
+        result = {"turn": turn + 1, "prompt": prompt, "turn_seconds": turn_seconds}
+        if trace_allocations:
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            diff = after.compare_to(before, "filename")
+            result["allocated_blocks"] = sum(
+                stat.count_diff for stat in diff if stat.count_diff > 0
+            )
+            result["allocated_kib"] = (
+                sum(stat.size_diff for stat in diff if stat.size_diff > 0) / 1024
+            )
+            result["peak_kib"] = peak / 1024
+        if app.exception:
+            result["error"] = str(app.exception[0].value)
+        # The agent's answer to a function call isn't streamed, those turns
+        # report the call's first token and the time spent answering it
+        history = app.session_state["chat_history"]
+        result["path"] = "function" if history[-1]["role"] == "function" else "stream"
+        stats = app.session_state["stream_stats"]
+        if stats:
+            result["time_to_first_token"] = stats["time_to_first_token"]
+            result["render_seconds"] = stats["render_seconds"]
+            result["tokens_per_second"] = stats["tokens_per_second"]
+            result["frames"] = stats["frames"]
+            result["attempts"] = len(stats["attempts"])
+            result["function_seconds"] = stats["function_seconds"]
+        results.append(result)
+    return results
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return "-"
+    ordered = sorted(values)
+    p95 = ordered[round(0.95 * (len(ordered) - 1))]
+    return f"median {statistics.median(ordered):.4f}  p95 {p95:.4f}"
+
+
+def print_report(results):
+    columns = [
+        ("turn", "{}"),
+        ("path", "{}"),
+        ("turn_seconds", "{:.3f}"),
+        ("time_to_first_token", "{:.3f}"),
+        ("render_seconds", "{:.4f}"),
+        ("tokens_per_second", "{:.1f}"),
+        ("frames", "{}"),
+        ("attempts", "{}"),
+        ("function_seconds", "{:.3f}"),
+        ("allocated_blocks", "{}"),
+        ("allocated_kib", "{:.1f}"),
+        ("peak_kib", "{:.1f}"),
+    ]
+    print("  ".join(name for name, _ in columns))
+    for result in results:
+        print(
+            "  ".join(
+                fmt.format(result[name]) if result.get(name) is not None else "-"
+                for name, fmt in columns
+            )
+            + (f"  error: {result['error']}" if "error" in result else "")
+        )
+    print()
+    for name in [
+        "turn_seconds",
+        "time_to_first_token",
+        "render_seconds",
+        "function_seconds",
+    ]:
+        print(f"{name:<20} {summarize([result.get(name) for result in results])}")
+    for name in ["allocated_blocks", "allocated_kib"]:
+        print(f"{name:<20} {summarize([result.get(name) for result in results])}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chat loop latency benchmark")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--agent-seconds",
+        type=float,
+        default=0.5,
+        help="Latency of the local QA agent, negative to run without an agent",
+    )
+    parser.add_argument("--hedge", action="store_true")
+    parser.add_argument("--json", help="Also write the per-turn results here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    try:
+        import streamlit.testing.v1  # noqa: F401
+    except ImportError:
+        sys.exit("This benchmark needs streamlit>=1.28 (streamlit.testing.v1)")
+
+    server = start_server(
+        port=0,
+        tokens_per_second=args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    os.environ["OPENAI_API_BASE"] = api_base(server)
+    os.environ["OPENAI_API_KEY"] = "sk-local"
+    install_offline_connections()
+    install_offline_history()
+    encoding = install_offline_encoding()
+    if encoding != "cl100k_base":
+        print("cl100k_base isn't available, counting tokens as bytes\n")
+    # Keep the embedding and centroid caches out of the working tree, and
+    # start every run cold so results are reproducible
+    os.chdir(tempfile.mkdtemp(prefix="bench-chat-loop-"))
+
+    # Timings and allocations come from separate passes, since tracemalloc
+    # slows down everything it traces
+    results = run_turns(args, trace_allocations=False)
+    for result, traced in zip(results, run_turns(args, trace_allocations=True)):
+        for key in ["allocated_blocks", "allocated_kib", "peak_kib"]:
+            result[key] = traced.get(key)
+
+    print_report(results)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
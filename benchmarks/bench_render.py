@@ -0,0 +1,110 @@
+# Benchmark of streamlit_handlers.render_conversation: rerun time against the
+# length of the chat history.
+#
+#   python benchmarks/bench_render.py --lengths 10 50 100 200 400 --reruns 20
+#
+# For each history length a small app holding that many messages is rerun
+# through streamlit's AppTest, once rendering every message (the previous
+# behaviour) and once with the default window of recent messages. Reported
+# times are per rerun, from the script run to the elements being produced,
+# so they cover the server side of a rerun but not the browser.
+#
+# Needs streamlit>=1.28 for streamlit.testing.
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APP = """
+import sys
+sys.path.insert(0, {repo_dir!r})
+import random
+import streamlit as st
+from streamlit_handlers import render_conversation
+
+if "chat_history" not in st.session_state:
+    generator = random.Random(0)
+    words = "franchise territory royalty investment training support brand".split()
+    st.session_state["chat_history"] = [{{"role": "system", "content": ""}}]
+    for index in range({length}):
+        role = ["user", "assistant", "function"][index % 3]
+        paragraphs = [
+            " ".join(generator.choice(words) for _ in range(60))
+            for _ in range({paragraphs})
+        ]
+        st.session_state["chat_history"].append(
+            {{"role": role, "content": "\\n\\n".join(paragraphs)}}
+        )
+
+render_conversation({recent})
+"""
+
+
+def time_reruns(length, recent, args):
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_string(
+        APP.format(
+            repo_dir=REPO_DIR,
+            length=length,
+            paragraphs=args.paragraphs,
+            recent=recent,
+        ),
+        default_timeout=120,
+    )
+    app.run()
+    if app.exception:
+        raise RuntimeError(app.exception[0].value)
+    seconds = []
+    for _ in range(args.reruns):
+        started = time.perf_counter()
+        app.run()
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Conversation rerun benchmark")
+    parser.add_argument(
+        "--lengths", type=int, nargs="+", default=[10, 50, 100, 200, 400]
+    )
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument(
+        "--paragraphs", type=int, default=3, help="Paragraphs per message"
+    )
+    parser.add_argument("--json", help="Also write the results here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        import streamlit.testing.v1  # noqa: F401
+    except ImportError:
+        sys.exit("This benchmark needs streamlit>=1.28 (streamlit.testing.v1)")
+
+    results = []
+    print("messages  full_median_ms  full_p95_ms  windowed_median_ms  windowed_p95_ms")
+    for length in args.lengths:
+        result = {"messages": length}
+        for name, recent in [("full", None), ("windowed", "")]:
+            seconds = sorted(time_reruns(length, recent, args))
+            result[f"{name}_median_ms"] = statistics.median(seconds) * 1000
+            result[f"{name}_p95_ms"] = seconds[round(0.95 * (len(seconds) - 1))] * 1000
+        results.append(result)
+        print(
+            f"{length:>8}  {result['full_median_ms']:>14.1f}  "
+            f"{result['full_p95_ms']:>11.1f}  {result['windowed_median_ms']:>18.1f}  "
+            f"{result['windowed_p95_ms']:>15.1f}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# Benchmark of the ingestion splitters in splitter_handlers.py: langchain's
+# recursive character splitter against the token splitter.
+#
+#   python benchmarks/bench_splitter.py --pdf files/fdd.pdf --workers 4
+#   python benchmarks/bench_splitter.py --pages 500
+#
+# Pages come from a PDF, or are generated when no --pdf is given, and are
+# extracted up front, so only splitting is timed. The token splitter runs
+# serially and with pages tokenized on a process pool, like ingestion does.
+# For each run it reports chunks/sec and the spread of chunk sizes in tokens,
+# along with the worst case prompt of --top-k stuffed chunks.
+#
+# Needs the tiktoken cl100k_base encoding in TIKTOKEN_CACHE_DIR to run offline.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from pdf_handlers import count_pages, encode_pages, get_encoding, read_pages  # noqa
+from splitter_handlers import (  # noqa: E402
+    CHUNK_TOKENS,
+    TOKEN_ENCODING,
+    get_text_splitter,
+    split_pages,
+    split_tokens,
+)
+
+PAGES_PER_TASK = 8
+
+WORDS = (
+    "franchise franchisee franchisor territory royalty investment training "
+    "support brand location revenue marketing fee agreement operations growth "
+    "market customers staff opening plan capital experience business initial "
+    "term renewal obligations disclosure item financial performance"
+).split()
+
+
+def generate_pages(page_count, words_per_page, seed):
+    generator = random.Random(seed)
+    pages = []
+    for _ in range(page_count):
+        words = []
+        for index in range(words_per_page):
+            words.append(generator.choice(WORDS))
+            if index % 14 == 13:
+                words[-1] += "."
+            if index % 90 == 89:
+                words[-1] += "\n\n"
+        pages.append(" ".join(words))
+    return pages
+
+
+def load_pages(args):
+    if args.pdf:
+        return read_pages(args.pdf, 0, count_pages(args.pdf))
+    return generate_pages(args.pages, args.words_per_page, args.seed)
+
+
+def tokenize_parallel(executor, pages):
+    tasks = [
+        executor.submit(
+            encode_pages, pages[start : start + PAGES_PER_TASK], TOKEN_ENCODING
+        )
+        for start in range(0, len(pages), PAGES_PER_TASK)
+    ]
+    for task in tasks:
+        yield from task.result()
+
+
+def run_recursive(pages, executor):
+    return list(split_pages(pages, get_text_splitter()))
+
+
+def run_token_serial(pages, executor):
+    encoding = get_encoding(TOKEN_ENCODING)
+    return list(split_tokens(encode_pages(pages, TOKEN_ENCODING), encoding))
+
+
+def run_token_parallel(pages, executor):
+    encoding = get_encoding(TOKEN_ENCODING)
+    return list(split_tokens(tokenize_parallel(executor, pages), encoding))
+
+
+def measure(name, run, pages, executor, repeats, top_k):
+    seconds = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        chunks = run(pages, executor)
+        seconds.append(time.perf_counter() - started)
+    encoding = get_encoding(TOKEN_ENCODING)
+    tokens = sorted(len(encoding.encode_ordinary(chunk)) for chunk in chunks)
+    mean = statistics.mean(tokens)
+    best = min(seconds)
+    return {
+        "splitter": name,
+        "chunks": len(chunks),
+        "seconds": best,
+        "chunks_per_second": len(chunks) / best if best else None,
+        "tokens_mean": mean,
+        "tokens_stdev": statistics.pstdev(tokens),
+        # Spread relative to the mean; lower packs the context more evenly
+        "tokens_cv": statistics.pstdev(tokens) / mean if mean else None,
+        "tokens_min": tokens[0],
+        "tokens_p95": tokens[round(0.95 * (len(tokens) - 1))],
+        "tokens_max": tokens[-1],
+        # Prompt size when the top_k largest chunks are retrieved together
+        "context_worst_case": sum(tokens[-top_k:]),
+        "within_10_percent": sum(
+            abs(count - CHUNK_TOKENS) <= CHUNK_TOKENS / 10 for count in tokens
+        )
+        / len(tokens),
+    }
+
+
+def print_report(results):
+    columns = [
+        ("splitter", "{}"),
+        ("chunks", "{}"),
+        ("seconds", "{:.3f}"),
+        ("chunks_per_second", "{:.0f}"),
+        ("tokens_mean", "{:.1f}"),
+        ("tokens_cv", "{:.3f}"),
+        ("tokens_min", "{}"),
+        ("tokens_p95", "{}"),
+        ("tokens_max", "{}"),
+        ("context_worst_case", "{}"),
+        ("within_10_percent", "{:.0%}"),
+    ]
+    print("  ".join(name for name, _ in columns))
+    for result in results:
+        print(
+            "  ".join(
+                fmt.format(result[name]) if result.get(name) is not None else "-"
+                for name, fmt in columns
+            )
+        )
+    print(f"\nwithin_10_percent: share of chunks within 10% of {CHUNK_TOKENS} tokens")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingestion splitter benchmark")
+    parser.add_argument("--pdf", help="Split the pages of this PDF")
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--top-k", type=int, default=8, help="Chunks stuffed into one prompt"
+    )
+    parser.add_argument("--json", help="Also write the results here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    pages = load_pages(args)
+    print(f"{len(pages)} pages, {sum(len(page) for page in pages)} characters\n")
+    executor = ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    # Start the workers and load the encoding in them before timing
+    list(tokenize_parallel(executor, ["warm up"] * PAGES_PER_TASK * args.workers))
+
+    results = [
+        measure(name, run, pages, executor, args.repeats, args.top_k)
+        for name, run in [
+            ("recursive", run_recursive),
+            ("token", run_token_serial),
+            (f"token x{args.workers}", run_token_parallel),
+        ]
+    ]
+    executor.shutdown()
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
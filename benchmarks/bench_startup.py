@@ -0,0 +1,238 @@
+# Cold-start report: where the time goes before the app can serve a session.
+#
+#   python benchmarks/bench_startup.py --top 15
+#
+# Every section runs in a fresh interpreter, so nothing is warm:
+#
+#   imports    python -X importtime over the app modules, per app module and
+#              per third-party package
+#   resources  each resource provider built on its own (vector index,
+#              embeddings, chat model, Postgres pool, ...) plus the first
+#              network round-trip each of them makes
+#   first run  one AppTest run of main.py, i.e. what a first visitor waits
+#              for, and which resources it built on the way
+#
+# Run it from a checkout with the app's .streamlit/secrets.toml and
+# OPENAI_API_KEY. A backend that is down shows up as an error with the time it
+# took to fail. Needs streamlit>=1.28 for streamlit.testing.
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Everything main.py and pages/knowledge_base.py import from the repo
+APP_MODULES = [
+    "connections",
+    "conversation_handlers",
+    "summary_handlers",
+    "history_handlers",
+    "streamlit_handlers",
+    "langchain_handlers",
+    "job_handlers",
+]
+
+# (name, module, provider, method) built in order: provider() and, when
+# given, its method() for the first round-trip to the backend
+RESOURCE_STEPS = [
+    ("vector_index", "vector_handlers", "get_vector_index", None),
+    ("namespaces", "cache_handlers", "get_namespace_catalog", "get"),
+    ("embeddings", "embedding_handlers", "get_embeddings", None),
+    ("chat", "langchain_handlers", "get_chat", None),
+    ("db_pool", "db_handlers", "get_db_pool", None),
+    ("system_prompt", "prompt_handlers", "get_prompt_cache", "get"),
+]
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self |   cumulative | <indent>module"
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def run_imports(args):
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "; ".join(f"import {module}" for module in APP_MODULES),
+        ],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall_seconds = time.perf_counter() - started
+    rows = parse_importtime(completed.stderr)
+    modules = [
+        {
+            "module": name,
+            "self_ms": self_us / 1000,
+            "cumulative_ms": cumulative_us / 1000,
+        }
+        for name, self_us, cumulative_us in rows
+        if name.split(".")[0] in APP_MODULES
+        or os.path.exists(os.path.join(REPO_DIR, f"{name}.py"))
+    ]
+    # Self time summed per top-level package, so a package is charged for all
+    # of its submodules whichever app module pulled them in
+    packages = defaultdict(int)
+    for name, self_us, _ in rows:
+        top = name.split(".")[0]
+        if not os.path.exists(os.path.join(REPO_DIR, f"{top}.py")):
+            packages[top] += self_us
+    return {
+        "wall_ms": wall_seconds * 1000,
+        "error": (
+            completed.stderr.strip().splitlines()[-1] if completed.returncode else None
+        ),
+        "modules": modules,
+        "packages": [
+            {"package": package, "self_ms": self_us / 1000}
+            for package, self_us in sorted(
+                packages.items(), key=lambda item: item[1], reverse=True
+            )[: args.top]
+        ],
+    }
+
+
+def resources_section():
+    # Runs in the child process
+    import importlib
+
+    results = []
+    for name, module, provider, method in RESOURCE_STEPS:
+        started = time.perf_counter()
+        imported = None
+        error = None
+        try:
+            resource = getattr(importlib.import_module(module), provider)
+            imported = time.perf_counter()
+            resource = resource()
+            if method:
+                getattr(resource, method)()
+        except Exception as e:
+            error = repr(e)
+        finished = time.perf_counter()
+        imported = imported or finished
+        results.append(
+            {
+                "resource": name,
+                "import_ms": (imported - started) * 1000,
+                "build_ms": (finished - imported) * 1000,
+                "error": error,
+            }
+        )
+    return results
+
+
+def first_run_section():
+    # Runs in the child process
+    from streamlit.testing.v1 import AppTest
+    from startup_handlers import resource_timings
+
+    app = AppTest.from_file(os.path.join(REPO_DIR, "main.py"), default_timeout=120)
+    started = time.perf_counter()
+    app.run()
+    return {
+        "run_ms": (time.perf_counter() - started) * 1000,
+        "error": str(app.exception[0].value) if app.exception else None,
+        "resources_built": {
+            name: timing["seconds"] * 1000 for name, timing in resource_timings.items()
+        },
+    }
+
+
+def run_section(section):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--section", section],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode or not lines:
+        return {"error": (completed.stderr.strip() or "no output").splitlines()[-1]}
+    return json.loads(lines[-1])
+
+
+def print_report(report):
+    imports = report["imports"]
+    print(f"imports: {imports['wall_ms']:.0f} ms for a fresh interpreter")
+    if imports["error"]:
+        print(f"  error: {imports['error']}")
+    print(f"  {'app module':<28} {'self_ms':>9} {'cumulative_ms':>14}")
+    for row in imports["modules"]:
+        print(
+            f"  {row['module']:<28} {row['self_ms']:>9.1f} {row['cumulative_ms']:>14.1f}"
+        )
+    print(f"  {'package':<28} {'self_ms':>9}")
+    for row in imports["packages"]:
+        print(f"  {row['package']:<28} {row['self_ms']:>9.1f}")
+    print()
+
+    print("resources:")
+    resources = report["resources"]
+    if isinstance(resources, dict):
+        print(f"  error: {resources['error']}")
+    else:
+        print(f"  {'resource':<28} {'import_ms':>9} {'build_ms':>9}")
+        for row in resources:
+            print(
+                f"  {row['resource']:<28} {row['import_ms']:>9.1f} {row['build_ms']:>9.1f}"
+                + (f"  error: {row['error']}" if row["error"] else "")
+            )
+    print()
+
+    first_run = report["first_run"]
+    if "run_ms" in first_run:
+        print(f"first run of main.py: {first_run['run_ms']:.0f} ms")
+        for name, ms in first_run["resources_built"].items():
+            print(f"  built {name:<22} {ms:>9.1f} ms")
+    if first_run.get("error"):
+        print(f"  error: {first_run['error']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark")
+    parser.add_argument("--top", type=int, default=15, help="Packages to list")
+    parser.add_argument("--json", help="Also write the report here")
+    parser.add_argument(
+        "--section", choices=["resources", "first_run"], help=argparse.SUPPRESS
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.section:
+        sys.path.insert(0, REPO_DIR)
+        section = {"resources": resources_section, "first_run": first_run_section}
+        print(json.dumps(section[args.section]()), flush=True)
+        # Background threads, e.g. the prompt listener, must not keep it alive
+        os._exit(0)
+
+    report = {
+        "imports": run_imports(args),
+        "resources": run_section("resources"),
+        "first_run": run_section("first_run"),
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
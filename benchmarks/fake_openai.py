@@ -0,0 +1,242 @@
+# Local stand-in for the OpenAI ChatCompletion and Embedding endpoints, used to
+# benchmark the chat loop offline. Point the app at it with
+#   OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=sk-local
+# and run
+#   python benchmarks/fake_openai.py --tokens-per-second 80 --drop-rate 0.1
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULTS = {
+    "host": "127.0.0.1",
+    "port": 8765,
+    # Streaming speed of generated replies
+    "tokens_per_second": 80.0,
+    "first_token_delay": 0.3,
+    "reply_tokens": 120,
+    # Replies to user messages containing this keyword are function calls
+    "function_call_keyword": "franchise",
+    "function_name": "respond_franchise_inquiry",
+    # Fraction of requests answered with a 500, and of streams cut midway
+    "error_rate": 0.0,
+    "drop_rate": 0.0,
+    "embedding_dimensions": 1536,
+    "seed": 0,
+}
+
+WORDS = (
+    "franchise owner territory royalty investment training support brand "
+    "location revenue marketing fee agreement operations growth market "
+    "customers staff opening plan capital experience business"
+).split()
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def chance(self, rate):
+        with self.server.lock:
+            return self.server.random.random() < rate
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.chance(self.config["error_rate"]):
+            return self.send_json(
+                500,
+                {"error": {"message": "Injected fault", "type": "server_error"}},
+            )
+        if self.path.endswith("/chat/completions"):
+            return self.chat_completion(body)
+        if self.path.endswith("/embeddings"):
+            return self.embeddings(body)
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def wants_function_call(self, body):
+        if not body.get("functions") or body.get("function_call") == "none":
+            return False
+        last = body["messages"][-1]
+        return last["role"] == "user" and (
+            self.config["function_call_keyword"] in (last.get("content") or "")
+        )
+
+    def reply_words(self, body):
+        seed = hashlib.sha256(json.dumps(body["messages"]).encode()).hexdigest()
+        generator = random.Random(seed)
+        return [
+            generator.choice(WORDS) + " " for _ in range(self.config["reply_tokens"])
+        ]
+
+    def chat_completion(self, body):
+        if self.wants_function_call(body):
+            inquiry = body["messages"][-1]["content"]
+            arguments = json.dumps({"inquiry": inquiry})
+            # Arguments arrive a few characters at a time, like the real API
+            pieces = [arguments[i : i + 8] for i in range(0, len(arguments), 8)]
+            deltas = [
+                {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {
+                        "name": self.config["function_name"],
+                        "arguments": "",
+                    },
+                }
+            ] + [{"function_call": {"arguments": piece}} for piece in pieces]
+            finish_reason = "function_call"
+        else:
+            deltas = [{"role": "assistant", "content": ""}] + [
+                {"content": word} for word in self.reply_words(body)
+            ]
+            finish_reason = "stop"
+
+        if not body.get("stream"):
+            prompt_tokens = sum(
+                len((message.get("content") or "").split())
+                for message in body["messages"]
+            )
+            message = {"role": "assistant", "content": None}
+            for delta in deltas:
+                if delta.get("content"):
+                    message["content"] = (message["content"] or "") + delta["content"]
+                if "function_call" in delta:
+                    message.setdefault("function_call", {"name": "", "arguments": ""})
+                    for key, value in delta["function_call"].items():
+                        message["function_call"][key] += value
+            return self.send_json(
+                200,
+                {
+                    "id": "chatcmpl-local",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": message,
+                            "finish_reason": finish_reason,
+                        }
+                    ],
+                    # One token per word of the prompt, one per delta
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(deltas) - 1,
+                        "total_tokens": prompt_tokens + len(deltas) - 1,
+                    },
+                },
+            )
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        drop_at = len(deltas) // 2 if self.chance(self.config["drop_rate"]) else None
+        time.sleep(self.config["first_token_delay"])
+        interval = 1 / self.config["tokens_per_second"]
+        chunks = [(delta, None) for delta in deltas] + [({}, finish_reason)]
+        try:
+            for index, (delta, finish) in enumerate(chunks):
+                if index == drop_at:
+                    # Cut the connection without [DONE], like a dropped stream
+                    return
+                chunk = {
+                    "id": "chatcmpl-local",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if index:
+                    time.sleep(interval)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled, e.g. a hedged request that lost
+            pass
+
+    def embedding(self, item):
+        # Deterministic unit vector per input, so caches and similarity
+        # behave the same on every run
+        seed = hashlib.sha256(json.dumps(item).encode()).hexdigest()
+        generator = random.Random(seed)
+        vector = [
+            generator.gauss(0, 1) for _ in range(self.config["embedding_dimensions"])
+        ]
+        norm = sum(value * value for value in vector) ** 0.5
+        return [value / norm for value in vector]
+
+    def embeddings(self, body):
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        self.send_json(
+            200,
+            {
+                "object": "list",
+                "model": body.get("model"),
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": self.embedding(item),
+                    }
+                    for index, item in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            },
+        )
+
+
+def start_server(**overrides):
+    # Starts the stand-in on a daemon thread; port 0 picks a free port
+    config = dict(DEFAULTS, **overrides)
+    server = ThreadingHTTPServer((config["host"], config["port"]), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.random = random.Random(config["seed"])
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def api_base(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local OpenAI stand-in")
+    for key, value in DEFAULTS.items():
+        parser.add_argument(
+            f"--{key.replace('_', '-')}", type=type(value), default=value
+        )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    server = start_server(**vars(parse_args()))
+    print(f"Serving OpenAI stand-in at {api_base(server)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,170 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+
+from vector_handlers import get_vector_index
+from startup_handlers import timed_resource
+
+# Cosine similarity above which two inquiries are considered the same question
+SIMILARITY_THRESHOLD = 0.95
+ANSWER_TTL_SECONDS = 24 * 60 * 60
+MAX_CACHED_ANSWERS = 1024
+# Longest the namespace directory may lag changes made outside the app
+NAMESPACE_CATALOG_TTL_SECONDS = 5 * 60
+
+
+class SemanticCache:
+    # Answers keyed by (inquiry embedding, set of namespaces the agent covers).
+    # A lookup hits when a cached inquiry over the same namespaces is at least
+    # `threshold` cosine-similar to the new one
+    def __init__(
+        self,
+        threshold=SIMILARITY_THRESHOLD,
+        ttl=ANSWER_TTL_SECONDS,
+        max_entries=MAX_CACHED_ANSWERS,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def expire(self, now):
+        expired = [
+            key
+            for key, entry in self.entries.items()
+            if now - entry["created_at"] > self.ttl
+        ]
+        for key in expired:
+            del self.entries[key]
+
+    def lookup(self, embedding, namespaces, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        namespaces = frozenset(namespaces)
+        vector = self.normalize(embedding)
+        with self.lock:
+            self.expire(time.time())
+            keys = [
+                key
+                for key, entry in self.entries.items()
+                if entry["namespaces"] == namespaces
+            ]
+            if keys:
+                matrix = np.stack([self.entries[key]["embedding"] for key in keys])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= threshold:
+                    self.entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self.entries[keys[best]]["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, namespaces, answer):
+        with self.lock:
+            self.entries[self.next_id] = {
+                "embedding": self.normalize(embedding),
+                "namespaces": frozenset(namespaces),
+                "answer": answer,
+                "created_at": time.time(),
+            }
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_namespaces(self, namespaces):
+        # Any answer that may have used one of these namespaces is stale
+        namespaces = set(namespaces)
+        with self.lock:
+            stale = [
+                key
+                for key, entry in self.entries.items()
+                if entry["namespaces"] & namespaces
+            ]
+            for key in stale:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Shared by every session, so a question answered for one user is served from
+# memory for the next
+@st.cache_resource
+def get_answer_cache():
+    return SemanticCache()
+
+
+class NamespaceCatalog:
+    # Namespaces of the vector index with their vector counts, fetched with
+    # one describe_index_stats call and shared until the TTL runs out.
+    # Ingestion and deletes update it directly, since the index stats can lag
+    # behind writes for a while
+    def __init__(self, describe, ttl=NAMESPACE_CATALOG_TTL_SECONDS):
+        self.describe = describe
+        self.ttl = ttl
+        self.counts = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        # Held while fetching, so concurrent page loads wait for one request
+        # instead of each making their own
+        self.fetch_lock = threading.Lock()
+
+    def fetch(self):
+        namespaces = self.describe().get("namespaces") or {}
+        return {
+            namespace: int(summary["vector_count"])
+            for namespace, summary in namespaces.items()
+        }
+
+    def get(self):
+        with self.fetch_lock:
+            with self.lock:
+                if (
+                    self.counts is not None
+                    and time.monotonic() - self.fetched_at < self.ttl
+                ):
+                    return dict(self.counts)
+            counts = self.fetch()
+            with self.lock:
+                self.counts = counts
+                self.fetched_at = time.monotonic()
+                return dict(counts)
+
+    def put(self, namespace, vector_count):
+        with self.lock:
+            if self.counts is not None:
+                self.counts[namespace] = vector_count
+
+    def discard(self, namespaces):
+        with self.lock:
+            if self.counts is not None:
+                for namespace in namespaces:
+                    self.counts.pop(namespace, None)
+
+    def invalidate(self):
+        with self.lock:
+            self.counts = None
+
+
+@st.cache_resource
+@timed_resource("namespace_catalog")
+def get_namespace_catalog():
+    return NamespaceCatalog(lambda: get_vector_index().describe_index_stats())
@@ -1,92 +1,103 @@
-import psycopg2
-import pinecone
+import time
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Pinecone
+from cache_handlers import get_answer_cache, get_namespace_catalog
+from db_handlers import execute_prepared, get_db_pool
+from ingestion_handlers import remove_manifests
+from prompt_handlers import PROMPT_CHANNEL, get_prompt_cache
+from router_handlers import get_namespace_router
+from vector_handlers import get_vector_index
 
 # This must be the first streamlit command called, otherwise it won't work
 st.set_page_config(page_title="ChatGPT Clone", page_icon="💬")
 
-# Connect to pinecone kb
-pinecone.init(
-    api_key=st.secrets["pinecone"]["api_key"],
-    environment=st.secrets["pinecone"]["env"],
+# Nothing else here runs at import: the vector index, the database pool and
+# the system prompt are built by their providers the first time they're used,
+# so the page renders before any backend has been reached
+
+# Namespaces deleted at once; each delete is one slow request to the index
+MAX_CONCURRENT_DELETES = st.secrets.get("vector_store", {}).get(
+    "max_concurrent_deletes", 8
 )
-# List all indexes in your Pinecone account
-active_indexes = pinecone.list_indexes()
 
-# Get namespaces for index called pdf-kb which is the only index at the moment
-pinecone_index = pinecone.Index(active_indexes[0])
 
+def fetch_versioned_system_prompt(wait=True):
+    # (version, prompt) from the process-wide cache, so no DB round-trip. With
+    # wait=False it's (None, None) until the prompt has loaded in the background
+    return get_prompt_cache().get(wait=wait)
 
-# These are functions streamlit runs when it starts
-# But then not run again because it is cached
-@st.cache_resource
-def connect_db():
-    try:
-        print("connecting to db...")
-        return psycopg2.connect(**st.secrets["postgres"])
-    except Exception as e:
-        print("Error=>", e)
-        return None
 
+def upload_prompt(file_content):
+    print("uploading file to db")
+
+    def upload(connection):
+        with connection.cursor() as cur2:
+            execute_prepared(cur2, "insert_update_prompt", (file_content,))
+            # Delivered on commit, every process reloads its cached prompt
+            cur2.execute(f"NOTIFY {PROMPT_CHANNEL}")
 
-@st.cache_resource
-def load_vector_store():
     try:
-        print("loading vector store...")
-        embeddings = OpenAIEmbeddings()
-        vector_store = Pinecone.from_existing_index(
-            embedding=embeddings,
-            index_name=st.secrets["pinecone"]["index_name"],
-        )
-        return vector_store
+        get_db_pool().run(upload)
+        # Don't wait for the notification to come back to this process
+        get_prompt_cache().load()
     except Exception as e:
-        print("Error=>", e)
-        return None
-
-
-db_connection = connect_db()
-vector_store = load_vector_store()
-
-
-def fetch_system_prompt():
-    print("fetching system prompt from db")
-    with db_connection.cursor() as cur:
-        query = "SELECT * FROM system_prompt;"
-        try:
-            cur.execute(query)
-            return cur.fetchall()[0][2]
-        except Exception as e:
-            print("Error=>", e)
-            return None
-
-
-def upload_prompt(file_content):
-    print("uploading file to db")
-    with db_connection.cursor() as cur2:
-        sql = "SELECT * FROM insert_update_prompt(%s);"
-        try:
-            cur2.execute(sql, (file_content,))
-            db_connection.commit()
-        except Exception as e:
-            print("Error:", e)
-            db_connection.rollback()
+        print("Error:", e)
 
 
 def fetch_namespaces():
-    index_description = pinecone_index.describe_index_stats()
-    namespaces = index_description.get("namespaces")
+    # Namespace -> vector count, from the shared catalog
+    return get_namespace_catalog().get()
+
 
-    return list(namespaces)
+@st.cache_resource
+def get_delete_executor():
+    return ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_DELETES, thread_name_prefix="namespace-delete"
+    )
 
 
-def delete_namespaces(namespaces):
+def delete_namespace(namespace):
+    result = {"namespace": namespace, "deleted": False, "seconds": None, "error": None}
+    started = time.perf_counter()
     try:
-        for np in namespaces:
-            pinecone_index.delete(delete_all=True, namespace=np)
-        return True
+        get_vector_index().delete(delete_all=True, namespace=namespace)
+        result["deleted"] = True
+        get_namespace_catalog().discard([namespace])
     except Exception as e:
         print("Error:", e)
-        return False
+        result["error"] = str(e)
+    # Even a partial delete makes cached answers over this namespace stale. A
+    # failed cleanup is reported with this namespace's result, it must not
+    # fail the other deletes running alongside
+    for cleanup in [
+        lambda: get_answer_cache().invalidate_namespaces([namespace]),
+        lambda: get_namespace_router().remove([namespace]),
+        lambda: remove_manifests([namespace]),
+    ]:
+        try:
+            cleanup()
+        except Exception as e:
+            print("Error:", e)
+            result["error"] = result["error"] or f"Cleanup failed: {e}"
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def delete_namespaces(namespaces, on_result=None):
+    # Deletes the namespaces concurrently, MAX_CONCURRENT_DELETES at a time, and
+    # returns one result per namespace, in order. on_result(result) is called
+    # from this thread as each one finishes, e.g. to report progress
+    futures = [
+        get_delete_executor().submit(delete_namespace, namespace)
+        for namespace in namespaces
+    ]
+    for future in as_completed(futures):
+        if on_result is not None:
+            on_result(future.result())
+    results = [future.result() for future in futures]
+    if not all(result["deleted"] for result in results):
+        # A failed delete may still have removed some vectors, so the counts
+        # are refetched on the next read
+        get_namespace_catalog().invalidate()
+    return results
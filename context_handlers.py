@@ -0,0 +1,139 @@
+import json
+from functools import lru_cache
+
+import tiktoken
+import streamlit as st
+
+from conversation_handlers import COMPLETION_TOKEN_RESERVE, GPT_MODEL
+
+# gpt-3.5-turbo-16k-0613 context length by default, lower to cap request size
+MAX_CONTEXT_TOKENS = st.secrets.get("chat", {}).get("max_context_tokens", 16384)
+# Every message is wrapped as <|start|>{role/name}\n{content}<|end|>\n
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+# Every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=GPT_MODEL):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(role, content, name, function_call, model):
+    encoding = get_encoding(model)
+    num_tokens = TOKENS_PER_MESSAGE + len(encoding.encode(role))
+    if content:
+        num_tokens += len(encoding.encode(content))
+    if name:
+        num_tokens += TOKENS_PER_NAME + len(encoding.encode(name))
+    if function_call:
+        num_tokens += len(encoding.encode(function_call))
+    return num_tokens
+
+
+def count_message_tokens(message, model=GPT_MODEL):
+    # Counts are memoized per message, so each turn only encodes the new messages
+    function_call = message.get("function_call")
+    return _count_tokens(
+        message["role"],
+        message.get("content"),
+        message.get("name"),
+        json.dumps(function_call, sort_keys=True) if function_call else None,
+        model,
+    )
+
+
+def count_functions_tokens(functions, model=GPT_MODEL):
+    # OpenAI injects the schema into the system message; the JSON dump is a
+    # slight overestimate, which is the safe side for a budget
+    if not functions:
+        return 0
+    return len(get_encoding(model).encode(json.dumps(functions)))
+
+
+def count_request_tokens(messages, functions=None, model=GPT_MODEL):
+    # Prompt tokens of a chat completion request, as billed
+    return (
+        TOKENS_PER_REPLY
+        + count_functions_tokens(functions, model)
+        + sum(count_message_tokens(message, model) for message in messages)
+    )
+
+
+def split_turns(messages):
+    # A turn starts at a user message and carries every assistant/function
+    # message that answers it, so function calls never lose their results
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def recent_window_start(messages, max_tokens, model=GPT_MODEL):
+    # Number of messages after the system prompt that come before the most
+    # recent turns fitting in `max_tokens`. The latest turn is always recent,
+    # however long it is
+    start = len(messages) - 1
+    for turn in reversed(split_turns(messages[1:])):
+        turn_tokens = sum(count_message_tokens(message, model) for message in turn)
+        if turn_tokens > max_tokens and start < len(messages) - 1:
+            break
+        start -= len(turn)
+        max_tokens -= turn_tokens
+    return start
+
+
+def summary_message(summary):
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation: {summary}",
+    }
+
+
+def build_context_window(
+    messages,
+    functions=None,
+    summary=None,
+    summarized=0,
+    max_tokens=MAX_CONTEXT_TOKENS,
+    completion_reserve=COMPLETION_TOKEN_RESERVE,
+    model=GPT_MODEL,
+):
+    # messages[0] is always the system prompt and is always sent. The first
+    # `summarized` messages after it are only sent through `summary`
+    system_messages = [messages[0]]
+    if summary:
+        system_messages.append(summary_message(summary))
+    history = messages[1 + summarized :]
+    budget = (
+        max_tokens
+        - completion_reserve
+        - TOKENS_PER_REPLY
+        - count_functions_tokens(functions, model)
+        - sum(count_message_tokens(message, model) for message in system_messages)
+    )
+
+    selected = []
+    for turn in reversed(split_turns(history)):
+        turn_tokens = sum(count_message_tokens(message, model) for message in turn)
+        if turn_tokens > budget:
+            if not selected:
+                # Not even the latest turn fits, keep as much of its tail as we can
+                for message in reversed(turn):
+                    message_tokens = count_message_tokens(message, model)
+                    if message_tokens > budget:
+                        break
+                    selected.insert(0, message)
+                    budget -= message_tokens
+            break
+        selected = turn + selected
+        budget -= turn_tokens
+
+    return system_messages + selected
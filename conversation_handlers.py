@@ -2,43 +2,381 @@ import streamlit as st
 import openai
 import os
 import json
-import requests
-from tenacity import retry, wait_random_exponential, stop_after_attempt
-from langchain.callbacks import get_openai_callback
+import time
+import queue
+import random
+import asyncio
+import threading
+from collections import deque
+import aiohttp
+
+from cache_handlers import get_answer_cache
+from embedding_handlers import get_embeddings
+from trace_handlers import (
+    TracingCallbackHandler,
+    get_current_span,
+    in_span,
+    start_span,
+    trace_span,
+)
 
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 GPT_MODEL = "gpt-3.5-turbo-16k-0613"
+# Marks the end of a stream pumped from the event loop into the script thread
+STREAM_END = object()
+# Attempts per streamed reply, counting restarts after a mid-stream failure
+MAX_STREAM_ATTEMPTS = 3
+# A stream that sends nothing for this long is considered dead
+STREAM_STALL_SECONDS = 30
+# Send a second request when the first token is slower than this percentile
+HEDGE_REQUESTS = st.secrets.get("chat", {}).get("hedge_requests", False)
+HEDGE_PERCENTILE = st.secrets.get("chat", {}).get("hedge_percentile", 95)
+# Room kept free in the context window for the reply, and the reply's limit
+COMPLETION_TOKEN_RESERVE = st.secrets.get("chat", {}).get(
+    "completion_token_reserve", 1024
+)
+CONTINUE_PROMPT = "Your previous reply was cut off. Continue it exactly where it stopped, without repeating anything already written."
 
 
-@retry(wait=wait_random_exponential(min=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(
-    messages, functions=None, function_call=None, model=GPT_MODEL
-):
+def respond_franchise_inquiry(inquiry, st_callback=None):
+    agent = st.session_state["agent"]
+    namespaces = st.session_state.get("agent_namespaces", [])
+    answer_cache = get_answer_cache()
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            functions=functions if functions is not None else [],
-            function_call=function_call if function_call is not None else "auto",
-            stream=True,
-        )
-        return response
+        with trace_span("answer_cache") as span:
+            inquiry_embedding = get_embeddings().embed_query(inquiry)
+            answer = answer_cache.lookup(inquiry_embedding, namespaces)
+            span.set(hit=answer is not None)
+        if answer is not None:
+            return answer
     except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
+        print("Error=>", e)
+        inquiry_embedding = None
 
-
-def respond_franchise_inquiry(inquiry, st_callback=None):
-    agent = st.session_state["agent"]
-    return agent.run(inquiry, callbacks=[st_callback])
+    answer = agent.run(
+        inquiry,
+        callbacks=[
+            callback
+            for callback in [st_callback, TracingCallbackHandler()]
+            if callback is not None
+        ],
+    )
+    if inquiry_embedding is not None:
+        answer_cache.store(inquiry_embedding, namespaces, answer)
+    return answer
 
 
 def execute_function_call(message, st_callback=None):
     if message["function_call"]["name"] == "respond_franchise_inquiry":
         inquiry = json.loads(message["function_call"]["arguments"])["inquiry"]
-        results = respond_franchise_inquiry(inquiry=inquiry, st_callback=st_callback)
+        with trace_span("function_call", function="respond_franchise_inquiry"):
+            results = respond_franchise_inquiry(
+                inquiry=inquiry, st_callback=st_callback
+            )
     else:
         results = f"Error: function {message['function_call']['name']} does not exist"
     return results
+
+
+# One event loop per process, running in a worker thread and shared by every
+# session, so network waits overlap instead of blocking each script run
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(
+        target=loop.run_forever, name="openai-event-loop", daemon=True
+    ).start()
+    return loop
+
+
+def submit(coroutine, span=None):
+    # Schedules a coroutine on the shared loop and returns a concurrent future.
+    # Spans it starts nest under `span`, by default the caller's current span
+    span = span if span is not None else get_current_span()
+    return asyncio.run_coroutine_threadsafe(in_span(span, coroutine), get_event_loop())
+
+
+_aiosession = None
+
+
+async def use_shared_aiosession():
+    # Only ever called on the shared loop, so no locking is needed. openai
+    # reads the session from a context variable, which is per task
+    global _aiosession
+    if _aiosession is None or _aiosession.closed:
+        _aiosession = aiohttp.ClientSession()
+    openai.aiosession.set(_aiosession)
+
+
+async def astart_chat_completion(
+    messages,
+    functions=None,
+    function_call=None,
+    model=GPT_MODEL,
+    max_tokens=COMPLETION_TOKEN_RESERVE,
+):
+    await use_shared_aiosession()
+    return await openai.ChatCompletion.acreate(
+        model=model,
+        messages=messages,
+        functions=functions if functions is not None else [],
+        function_call=function_call if function_call is not None else "auto",
+        max_tokens=max_tokens,
+        stream=True,
+    )
+
+
+class LatencyTracker:
+    # Recent time-to-first-token samples, only touched from the event loop
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, percentile):
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        index = round(percentile / 100 * (len(ordered) - 1))
+        return ordered[index]
+
+
+ttft_tracker = LatencyTracker()
+
+
+async def next_chunk(stream):
+    try:
+        return await asyncio.wait_for(stream.__anext__(), STREAM_STALL_SECONDS)
+    except StopAsyncIteration:
+        return None
+
+
+async def close_stream(stream):
+    try:
+        await stream.aclose()
+    except Exception:
+        pass
+
+
+async def open_stream(request):
+    stream = (await astart_chat_completion(**request)).__aiter__()
+    chunk = await next_chunk(stream)
+    if chunk is None:
+        raise ConnectionError("ChatCompletion stream closed before the first chunk")
+    return chunk, stream
+
+
+async def open_stream_hedged(request, hedge):
+    # Returns the first chunk, the stream it came from and whether it came
+    # from the hedged request. The slower request is cancelled
+    primary = asyncio.ensure_future(open_stream(request))
+    tasks = [primary]
+    try:
+        delay = ttft_tracker.percentile(HEDGE_PERCENTILE) if hedge else None
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done:
+                backup = asyncio.ensure_future(open_stream(request))
+                tasks.append(backup)
+                pending = {primary, backup}
+                error = None
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    winners = [task for task in done if task.exception() is None]
+                    if winners:
+                        for task in pending:
+                            task.cancel()
+                        for task in winners[1:]:
+                            await close_stream(task.result()[1])
+                        chunk, stream = winners[0].result()
+                        return chunk, stream, winners[0] is backup
+                    error = next(iter(done)).exception()
+                raise error
+        chunk, stream = await primary
+        return chunk, stream, False
+    except asyncio.CancelledError:
+        # Nothing was returned, so no request may be left open
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await close_stream(task.result()[1])
+        raise
+
+
+def end_attempt_span(span, metrics, error=None):
+    if span.recording:
+        span.set(
+            hedged=metrics["hedged"],
+            time_to_first_token=metrics["time_to_first_token"],
+        )
+    span.end(error)
+
+
+async def aresilient_chat_completion(
+    messages,
+    functions=None,
+    function_call=None,
+    model=GPT_MODEL,
+    max_attempts=MAX_STREAM_ATTEMPTS,
+    hedge=HEDGE_REQUESTS,
+    attempts=None,
+    prompt_tokens=0,
+):
+    # Streams a reply, restarting it when the stream fails or stalls midway.
+    # Text already yielded is kept and the model is asked to continue it;
+    # function call chunks are held back until the call is complete, so a
+    # failed call is simply requested again. Per-attempt latency metrics are
+    # appended to `attempts`, and each attempt is traced as a span
+    attempts = attempts if attempts is not None else []
+    content = ""
+    content_tokens = 0
+    for attempt in range(1, max_attempts + 1):
+        request = {
+            "messages": messages,
+            "functions": functions,
+            "function_call": function_call,
+            "model": model,
+        }
+        if content:
+            request["messages"] = messages + [
+                {"role": "assistant", "content": content},
+                {"role": "system", "content": CONTINUE_PROMPT},
+            ]
+            request["function_call"] = "none"
+            # The reply so far already used part of its limit
+            request["max_tokens"] = COMPLETION_TOKEN_RESERVE - content_tokens
+        metrics = {
+            "attempt": attempt,
+            "resumed": bool(content),
+            "hedged": False,
+            "time_to_first_token": None,
+            "seconds": None,
+            "error": None,
+        }
+        attempts.append(metrics)
+        # Streamed replies carry no usage, every content or arguments chunk
+        # is one token; a resumed attempt is sent the text so far again
+        span = start_span(
+            "chat_completion.attempt",
+            model=model,
+            attempt=attempt,
+            resumed=bool(content),
+            prompt_tokens=prompt_tokens + content_tokens,
+        )
+        started = time.perf_counter()
+        held = []
+        stream = None
+        error = None
+        try:
+            chunk, stream, metrics["hedged"] = await open_stream_hedged(request, hedge)
+            metrics["time_to_first_token"] = time.perf_counter() - started
+            ttft_tracker.add(metrics["time_to_first_token"])
+            finish_reason = None
+            while chunk is not None:
+                delta = chunk["choices"][0]["delta"]
+                finish_reason = chunk["choices"][0]["finish_reason"]
+                if delta.get("content") or delta.get("function_call"):
+                    span.add(completion_tokens=1)
+                if "function_call" in delta or held:
+                    held.append(chunk)
+                    if finish_reason is not None:
+                        for held_chunk in held:
+                            yield held_chunk
+                else:
+                    content += delta.get("content") or ""
+                    content_tokens += 1 if delta.get("content") else 0
+                    yield chunk
+                chunk = await next_chunk(stream)
+            if finish_reason is None:
+                raise ConnectionError("ChatCompletion stream ended without finishing")
+            metrics["seconds"] = time.perf_counter() - started
+            return
+        except Exception as e:
+            error = e
+            metrics["error"] = repr(e)
+            metrics["seconds"] = time.perf_counter() - started
+            print(f"ChatCompletion attempt {attempt} failed")
+            print(f"Exception: {e}")
+            if stream is not None:
+                await close_stream(stream)
+            if attempt == max_attempts:
+                raise
+        except BaseException as e:
+            # Cancelled, e.g. by a consumer that stopped reading. Close the
+            # stream so the rest of the completion isn't read and paid for
+            error = e
+            if stream is not None:
+                await close_stream(stream)
+            raise
+        finally:
+            end_attempt_span(span, metrics, error)
+        # Outside the attempt, so its span doesn't include the backoff
+        await asyncio.sleep(random.uniform(0, min(2**attempt, 10)))
+
+
+async def pump_stream(stream, chunks):
+    # Reads the stream on the event loop as fast as the network allows, while
+    # the script thread renders whatever has already arrived
+    try:
+        async for chunk in stream:
+            chunks.put(chunk)
+    except Exception as e:
+        print("Unable to generate ChatCompletion response")
+        print(f"Exception: {e}")
+        chunks.put(e)
+    finally:
+        chunks.put(STREAM_END)
+
+
+def stream_chat_completion(
+    messages,
+    functions=None,
+    function_call=None,
+    model=GPT_MODEL,
+    attempts=None,
+    prompt_tokens=0,
+):
+    chunks = queue.Queue()
+    span = start_span("chat_completion", messages=len(messages))
+    future = submit(
+        pump_stream(
+            aresilient_chat_completion(
+                messages,
+                functions=functions,
+                function_call=function_call,
+                model=model,
+                attempts=attempts,
+                prompt_tokens=prompt_tokens,
+            ),
+            chunks,
+        ),
+        span=span,
+    )
+    # Ended here rather than with trace_span, which would make the span current
+    # in the caller's context between chunks
+    error = None
+    finished = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is STREAM_END:
+                finished = True
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        # The consumer stopped reading, e.g. on a rerun or the Stop button,
+        # so stop the producer too instead of letting it finish the reply
+        if not finished:
+            future.cancel()
+        span.end(error)
@@ -0,0 +1,137 @@
+import time
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import streamlit as st
+from psycopg2.pool import ThreadedConnectionPool
+
+from startup_handlers import timed_resource
+
+# Connections are opened on demand up to DB_MAX_CONNECTIONS, so the app still
+# starts while the database is down. Up to DB_MIN_CONNECTIONS returned ones are
+# kept open for reuse, psycopg2's pool closes any returned past its minconn
+DB_MIN_CONNECTIONS = 5
+DB_MAX_CONNECTIONS = 10
+# A connection idle for longer is pinged before it is handed out
+DB_HEALTH_CHECK_SECONDS = 30
+# Tries per operation, each on a fresh connection after a connection error
+DB_ATTEMPTS = 2
+# Errors that mean the connection or the server went away, not the statement
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Statements prepared on each connection the first time they are used
+PREPARED_STATEMENTS = {
+    # xmin, then every column of system_prompt; the prompt text is its third
+    "fetch_system_prompt": "SELECT xmin::text, * FROM system_prompt LIMIT 1",
+    "fetch_system_prompt_version": "SELECT xmin::text FROM system_prompt LIMIT 1",
+    "insert_update_prompt": "SELECT * FROM insert_update_prompt($1)",
+    "load_conversation": "SELECT role, name, content, function_call"
+    " FROM conversation_messages WHERE conversation_id = $1 ORDER BY position",
+}
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # Remembers the statements prepared on it and when it was last used
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+def execute_prepared(cursor, name, params=()):
+    connection = cursor.connection
+    if name not in connection.prepared:
+        cursor.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        connection.prepared.add(name)
+    if params:
+        placeholders = ", ".join("%s" for _ in params)
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+
+class ConnectionPool:
+    # Thread-safe pool over psycopg2's ThreadedConnectionPool. Callers wait for
+    # a free connection instead of failing when all are in use, broken
+    # connections are replaced, and an operation that hits a connection error
+    # is retried once on a new connection
+    def __init__(
+        self,
+        connect_kwargs,
+        min_connections=DB_MIN_CONNECTIONS,
+        max_connections=DB_MAX_CONNECTIONS,
+    ):
+        # Built empty, minconn would connect right away, and raised afterwards so
+        # returned connections are kept
+        self.pool = ThreadedConnectionPool(
+            0,
+            max_connections,
+            connection_factory=PooledConnection,
+            **connect_kwargs,
+        )
+        self.pool.minconn = min_connections
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+        # A connection error usually means the server went away, taking every
+        # idle connection with it; those get pinged before being reused
+        self.suspect_before = 0
+
+    def healthy(self, connection):
+        if connection.closed:
+            return False
+        if (
+            connection.last_used > self.suspect_before
+            and time.monotonic() - connection.last_used < DB_HEALTH_CHECK_SECONDS
+        ):
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        for _ in range(self.max_connections + 1):
+            connection = self.pool.getconn()
+            if self.healthy(connection):
+                return connection
+            self.pool.putconn(connection, close=True)
+        raise psycopg2.OperationalError("No healthy database connection")
+
+    def run(self, operation, attempts=DB_ATTEMPTS):
+        # Runs operation(connection) in a transaction and returns its result
+        for attempt in range(attempts):
+            with self.slots:
+                connection = None
+                broken = False
+                try:
+                    connection = self.getconn()
+                    result = operation(connection)
+                    connection.commit()
+                    connection.last_used = time.monotonic()
+                    return result
+                except CONNECTION_ERRORS:
+                    self.suspect_before = time.monotonic()
+                    broken = True
+                    if attempt == attempts - 1:
+                        raise
+                except Exception:
+                    if connection is not None:
+                        try:
+                            connection.rollback()
+                        except psycopg2.Error:
+                            broken = True
+                    raise
+                finally:
+                    # Always handed back, or the pool would lose the slot for good
+                    if connection is not None:
+                        self.pool.putconn(connection, close=broken)
+
+
+@st.cache_resource
+@timed_resource("db_pool")
+def get_db_pool():
+    print("creating db connection pool...")
+    return ConnectionPool(st.secrets["postgres"])
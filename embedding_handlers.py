@@ -0,0 +1,204 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+from startup_handlers import timed_resource
+from trace_handlers import count_tokens, trace_span
+
+EMBEDDING_CACHE_DIR = os.path.join(".cache", "embeddings")
+MEMORY_CACHE_ENTRIES = 4096
+
+
+class EmbeddingStore:
+    # Append-only on-disk store: vectors.bin holds float16 rows, keys.txt holds
+    # one content hash per line in the same order. Rows are read through a
+    # memory map, so the whole store never has to fit in memory
+    def __init__(self, directory, dtype=np.float16):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(directory, "vectors.bin")
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.rows = {}
+        self.dimensions = None
+        self.matrix = None
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as f:
+            self.dimensions = json.load(f)["dimensions"]
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path) as f:
+            # The last line is only non-empty when its write was cut short
+            keys = f.read().split("\n")[:-1]
+        # A crash between the two appends leaves one file ahead of the other.
+        # Both are cut back to the rows they have in common, otherwise every
+        # row appended later would be paired with another text's key
+        rows = min(len(keys), self.vector_rows())
+        self.truncate(rows, sum(len(key.encode("utf-8")) + 1 for key in keys[:rows]))
+        self.rows = {key: row for row, key in enumerate(keys[:rows])}
+
+    def vector_rows(self):
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (
+            self.dimensions * self.dtype.itemsize
+        )
+
+    def file_size(self, path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def truncate(self, rows, keys_bytes):
+        vectors_bytes = rows * self.dimensions * self.dtype.itemsize
+        if self.file_size(self.vectors_path) > vectors_bytes:
+            os.truncate(self.vectors_path, vectors_bytes)
+        if self.file_size(self.keys_path) > keys_bytes:
+            os.truncate(self.keys_path, keys_bytes)
+
+    def remap(self):
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path):
+            self.matrix = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r"
+            ).reshape(-1, self.dimensions)
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self.matrix is None or row >= len(self.matrix):
+            self.remap()
+        return np.asarray(self.matrix[row], dtype=np.float32)
+
+    def put(self, items):
+        if not items:
+            return
+        if self.dimensions is None:
+            self.dimensions = len(items[0][1])
+            with open(self.meta_path, "w") as f:
+                json.dump({"dimensions": self.dimensions}, f)
+        # Keep the on-disk row order aligned with keys.txt
+        next_row = self.vector_rows()
+        keys_bytes = self.file_size(self.keys_path)
+        vectors = np.asarray([vector for _, vector in items], dtype=self.dtype)
+        try:
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self.keys_path, "a") as f:
+                f.write("".join(f"{key}\n" for key, _ in items))
+        except BaseException:
+            # e.g. a full disk, undo whichever append got through
+            self.truncate(next_row, keys_bytes)
+            raise
+        for offset, (key, _) in enumerate(items):
+            self.rows[key] = next_row + offset
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an Embeddings model with a content-hash keyed cache: a bounded LRU
+    # in memory over an EmbeddingStore on disk. Identical texts are only ever
+    # sent to the API once
+    def __init__(
+        self,
+        embeddings,
+        cache_dir=EMBEDDING_CACHE_DIR,
+        memory_entries=MEMORY_CACHE_ENTRIES,
+    ):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", embeddings.__class__.__name__)
+        self.store = EmbeddingStore(os.path.join(cache_dir, self.model))
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return vector
+        vector = self.store.get(key)
+        if vector is not None:
+            self.remember(key, vector)
+            self.disk_hits += 1
+            return vector
+        return None
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = {}
+        missing = OrderedDict()
+        with self.lock:
+            for key, text in zip(keys, texts):
+                if key in vectors or key in missing:
+                    continue
+                vector = self.lookup(key)
+                if vector is None:
+                    missing[key] = text
+                else:
+                    vectors[key] = vector
+
+        if missing:
+            with trace_span(
+                "embedding", model=self.model, texts=len(missing), cached=len(vectors)
+            ) as span:
+                if span.recording:
+                    span.set(prompt_tokens=count_tokens(*missing.values()))
+                fresh = self.embeddings.embed_documents(list(missing.values()))
+            items = [
+                (key, np.asarray(vector, dtype=np.float32))
+                for key, vector in zip(missing.keys(), fresh)
+            ]
+            with self.lock:
+                self.misses += len(items)
+                self.store.put(items)
+                for key, vector in items:
+                    self.remember(key, vector)
+                    vectors[key] = vector
+
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": len(self.store),
+            }
+
+
+# Every module embeds through this one provider, so they share the cache
+@st.cache_resource
+@timed_resource("embeddings")
+def get_embeddings():
+    return CachedEmbeddings(OpenAIEmbeddings())
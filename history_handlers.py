@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+from collections import Counter
+from functools import partial
+
+import streamlit as st
+from psycopg2.extras import execute_values
+
+from db_handlers import CONNECTION_ERRORS, execute_prepared, get_db_pool
+from startup_handlers import timed_resource
+
+# Messages written per INSERT; the writer takes whatever is queued up to this
+MESSAGE_BATCH_SIZE = 100
+# Past this many unwritten messages, e.g. while Postgres is down, new ones are
+# dropped rather than blocking a chat turn
+MAX_PENDING_MESSAGES = 10000
+MAX_RETRY_SECONDS = 30
+# Tries per batch while the database is unreachable, about 8 minutes of
+# backoff, before the batch is set aside
+MAX_WRITE_ATTEMPTS = 20
+# How long a restore waits for the conversation's queued messages to be written
+RESTORE_FLUSH_SECONDS = 10
+# Messages that couldn't be written, one JSON object per line
+DEAD_LETTER_FILE = os.path.join(".cache", "dead_letters", "conversation_messages.jsonl")
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    name TEXT,
+    content TEXT,
+    function_call JSONB,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (conversation_id, position)
+);
+"""
+
+
+class ConversationStore:
+    # Write-behind store for chat histories. Chat turns only put messages on a
+    # queue; a writer thread inserts whatever has queued up in one batch, and
+    # retries it while the database is unreachable. Messages that can't be
+    # written are set aside in DEAD_LETTER_FILE. Restoring waits for the
+    # conversation's queued messages, then is one primary key range scan over
+    # conversation_messages
+    def __init__(self, pool, batch_size=MESSAGE_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.pending = queue.Queue(maxsize=MAX_PENDING_MESSAGES)
+        self.tables_ready = False
+        # Conversation id -> messages queued or being written
+        self.unwritten = Counter()
+        self.unwritten_changed = threading.Condition()
+        threading.Thread(target=self.write_behind, daemon=True).start()
+
+    def append(self, conversation_id, position, message):
+        with self.unwritten_changed:
+            try:
+                self.pending.put_nowait((conversation_id, position, message))
+            except queue.Full:
+                print("Error=> conversation write buffer is full, dropping a message")
+                return
+            self.unwritten[conversation_id] += 1
+
+    def write(self, connection, batch):
+        with connection.cursor() as cur:
+            if not self.tables_ready:
+                cur.execute(CREATE_TABLES)
+            execute_values(
+                cur,
+                "INSERT INTO conversations (id) VALUES %s"
+                " ON CONFLICT (id) DO UPDATE SET updated_at = now()",
+                [(id,) for id in {id for id, _, _ in batch}],
+            )
+            execute_values(
+                cur,
+                "INSERT INTO conversation_messages"
+                " (conversation_id, position, role, name, content, function_call)"
+                " VALUES %s ON CONFLICT (conversation_id, position) DO NOTHING",
+                [
+                    (
+                        id,
+                        position,
+                        message["role"],
+                        message.get("name"),
+                        message.get("content"),
+                        (
+                            json.dumps(message["function_call"])
+                            if message.get("function_call")
+                            else None
+                        ),
+                    )
+                    for id, position, message in batch
+                ],
+                template="(%s, %s, %s, %s, %s, %s::jsonb)",
+            )
+
+    def write_behind(self):
+        batch = []
+        attempts = 0
+        while True:
+            if not batch:
+                batch.append(self.pending.get())
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.pool.run(partial(self.write, batch=batch))
+                self.tables_ready = True
+            except CONNECTION_ERRORS as e:
+                attempts += 1
+                if attempts < MAX_WRITE_ATTEMPTS:
+                    print("Error=>", e)
+                    time.sleep(min(2 ** (attempts - 1), MAX_RETRY_SECONDS))
+                    continue
+                self.dead_letter(batch, e)
+            except Exception as e:
+                print("Error=>", e)
+                # Something in the batch itself, e.g. a NUL byte in a message, so
+                # retrying it won't help; row by row, only the bad ones are lost
+                self.write_rows(batch)
+            self.finished(batch)
+            batch = []
+            attempts = 0
+
+    def finished(self, batch):
+        # The batch is written or set aside, either way it's no longer pending
+        with self.unwritten_changed:
+            for id, _, _ in batch:
+                self.unwritten[id] -= 1
+                if not self.unwritten[id]:
+                    del self.unwritten[id]
+            self.unwritten_changed.notify_all()
+
+    def flush(self, conversation_id, timeout=RESTORE_FLUSH_SECONDS):
+        # Waits until the conversation's queued messages are written, so a
+        # restore doesn't read it half-saved and write over the rest later
+        with self.unwritten_changed:
+            if not self.unwritten_changed.wait_for(
+                lambda: not self.unwritten[conversation_id], timeout
+            ):
+                raise TimeoutError(
+                    f"Conversation {conversation_id} still has unsaved messages"
+                )
+
+    def write_rows(self, batch):
+        for row in batch:
+            try:
+                self.pool.run(partial(self.write, batch=[row]))
+                self.tables_ready = True
+            except Exception as e:
+                self.dead_letter([row], e)
+
+    def dead_letter(self, batch, error):
+        print(f"Error=> unable to save {len(batch)} conversation messages:", error)
+        try:
+            os.makedirs(os.path.dirname(DEAD_LETTER_FILE), exist_ok=True)
+            with open(DEAD_LETTER_FILE, "a") as f:
+                for id, position, message in batch:
+                    record = {
+                        "conversation_id": id,
+                        "position": position,
+                        "message": message,
+                        "error": repr(error),
+                    }
+                    f.write(json.dumps(record, default=str) + "\n")
+        except Exception as e:
+            print("Error=>", e)
+
+    def load(self, conversation_id, timeout=RESTORE_FLUSH_SECONDS):
+        self.flush(conversation_id, timeout)
+
+        def fetch(connection):
+            with connection.cursor() as cur:
+                execute_prepared(cur, "load_conversation", (conversation_id,))
+                return cur.fetchall()
+
+        messages = []
+        for role, name, content, function_call in self.pool.run(fetch):
+            message = {"role": role, "content": content}
+            if name is not None:
+                message["name"] = name
+            if function_call is not None:
+                message["function_call"] = function_call
+            messages.append(message)
+        return messages
+
+
+@st.cache_resource
+@timed_resource("conversation_store")
+def get_conversation_store():
+    return ConversationStore(get_db_pool())
+
+
+def start_conversation(conversation_id=None, saved=0):
+    conversation_id = conversation_id or uuid.uuid4().hex
+    st.session_state["conversation"] = {"id": conversation_id, "saved": saved}
+    # The URL names the conversation, so a refresh or a shared link restores it
+    st.experimental_set_query_params(conversation=conversation_id)
+
+
+def init_conversation():
+    # Returns the messages of the conversation named in the URL, if any
+    conversation_id = st.experimental_get_query_params().get("conversation", [None])[0]
+    messages = []
+    if conversation_id:
+        try:
+            messages = get_conversation_store().load(conversation_id)
+        except Exception as e:
+            print("Error=>", e)
+            # Start over rather than write over messages that couldn't be read
+            conversation_id = None
+    start_conversation(conversation_id, saved=len(messages))
+    return messages
+
+
+def save_conversation():
+    # Queues the messages added since the last save, without waiting on the DB
+    conversation = st.session_state["conversation"]
+    messages = st.session_state["chat_history"][1:]
+    try:
+        store = get_conversation_store()
+    except Exception as e:
+        print("Error=>", e)
+        return
+    for position in range(conversation["saved"], len(messages)):
+        store.append(conversation["id"], position, messages[position])
+    conversation["saved"] = len(messages)
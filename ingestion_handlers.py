@@ -0,0 +1,418 @@
+import os
+import time
+import hashlib
+import queue
+import random
+import threading
+import multiprocessing
+from collections import deque
+from urllib.parse import quote
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import openai
+import streamlit as st
+
+from cache_handlers import get_answer_cache, get_namespace_catalog
+from embedding_handlers import get_embeddings
+from pdf_handlers import count_pages, get_encoding, read_pages, read_page_tokens
+from router_handlers import get_namespace_router
+from splitter_handlers import (
+    TOKEN_ENCODING,
+    get_text_splitter,
+    split_pages,
+    split_tokens,
+)
+from vector_handlers import IndexVectorStore, get_vector_index
+
+# Pages handed to a PDF worker at a time
+PAGES_PER_TASK = 8
+# Bounds on work in flight between stages, which keeps memory flat
+MAX_PENDING_TASKS = 8
+PAGE_QUEUE_SIZE = 32
+BATCH_QUEUE_SIZE = 4
+UPSERT_BATCH_SIZE = 128
+# "token" sizes chunks in tokens of the embedding and chat models' encoding,
+# "recursive" in characters with langchain's RecursiveCharacterTextSplitter
+SPLITTER = st.secrets.get("ingestion", {}).get("splitter", "token")
+# Batches being embedded and upserted at once by a single upload
+MAX_INFLIGHT_BATCHES = st.secrets.get("ingestion", {}).get("max_inflight_batches", 4)
+# Upload workers shared by every session
+UPLOAD_WORKERS = 16
+RATE_LIMIT_RETRIES = 6
+MAX_BACKOFF_SECONDS = 60
+MANIFEST_DIR = os.path.join(".cache", "manifests")
+# Ids per delete or fetch request when pruning removed chunks
+PRUNE_BATCH_SIZE = 100
+
+
+@st.cache_resource
+def get_pdf_executor():
+    # spawn rather than fork, forking the multi-threaded server is unsafe
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@st.cache_resource
+def get_upload_executor():
+    return ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
+
+def is_rate_limited(error):
+    # openai raises RateLimitError, pinecone an ApiException with status 429
+    return isinstance(error, openai.error.RateLimitError) or 429 in (
+        getattr(error, "status", None),
+        getattr(error, "http_status", None),
+    )
+
+
+class RateLimitGate:
+    # Shared by the workers of one upload. A rate limit hit by any of them
+    # pauses all of them until the backoff is over and halves how many batches
+    # may be in flight; every batch that goes through lets one more back in
+    def __init__(self, max_inflight=MAX_INFLIGHT_BATCHES):
+        self.max_inflight = max_inflight
+        self.inflight = max_inflight
+        self.resume_at = 0
+        self.rate_limits = 0
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            with self.lock:
+                delay = self.resume_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                backoff = min(2**attempt, MAX_BACKOFF_SECONDS)
+                with self.lock:
+                    self.rate_limits += 1
+                    self.inflight = max(1, self.inflight // 2)
+                    self.resume_at = max(
+                        self.resume_at,
+                        time.monotonic() + backoff * random.uniform(0.5, 1),
+                    )
+                continue
+            with self.lock:
+                self.inflight = min(self.max_inflight, self.inflight + 1)
+            return result
+
+
+def chunk_id(text):
+    # Same content hash the embedding cache keys on, so an unchanged chunk
+    # always gets the same id and a re-upload overwrites rather than duplicates
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ChunkManifest:
+    # Ids of the chunks a namespace holds in the index, one per line. Ids are
+    # appended as soon as their batch is upserted, so an interrupted upload
+    # leaves behind exactly what made it in, and the next one skips those
+    def __init__(self, namespace, directory=MANIFEST_DIR):
+        self.path = os.path.join(directory, quote(namespace, safe="") + ".ids")
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        if not self.exists():
+            return set()
+        with open(self.path) as f:
+            return set(f.read().split())
+
+    def add(self, ids):
+        with self.lock, open(self.path, "a") as f:
+            f.write("".join(f"{id}\n" for id in ids))
+
+    def replace(self, ids):
+        with self.lock:
+            with open(self.path + ".tmp", "w") as f:
+                f.write("".join(f"{id}\n" for id in ids))
+            os.replace(self.path + ".tmp", self.path)
+
+    def delete(self):
+        with self.lock:
+            if self.exists():
+                os.remove(self.path)
+
+
+def remove_manifests(namespaces):
+    for namespace in namespaces:
+        ChunkManifest(namespace).delete()
+
+
+def upload_batch(vector_store, router, manifest, gate, batch):
+    ids, texts = zip(*batch)
+    vectors = gate.call(vector_store.embedding.embed_documents, list(texts))
+    gate.call(vector_store.add_embeddings, list(texts), vectors, ids=list(ids))
+    manifest.add(ids)
+    router.add(vector_store.namespace, vectors)
+    return len(batch)
+
+
+def list_chunk_ids(index, namespace):
+    # Every id in the namespace, or None when the index can't list them, like
+    # pinecone.Index in the client version this app uses
+    list_ids = getattr(index, "list_ids", None)
+    if list_ids is None:
+        return None
+    return set(list_ids(namespace))
+
+
+def prune_chunks(index, router, namespace, ids):
+    # Deletes chunks that are no longer in the document, taking their vectors
+    # back out of the namespace centroid first
+    ids = list(ids)
+    for start in range(0, len(ids), PRUNE_BATCH_SIZE):
+        batch = ids[start : start + PRUNE_BATCH_SIZE]
+        fetched = index.fetch(ids=batch, namespace=namespace)["vectors"]
+        router.subtract(namespace, [vector["values"] for vector in fetched.values()])
+        index.delete(ids=batch, namespace=namespace)
+
+
+class StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+_STAGE_END = object()
+
+
+def run_stage(items, maxsize):
+    # Produces `items` on its own thread and hands them over through a bounded
+    # queue, so a slow consumer holds the producer back instead of piling up
+    # results in memory
+    results = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(StageError(e))
+        finally:
+            put(_STAGE_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = results.get()
+            if item is _STAGE_END:
+                return
+            if isinstance(item, StageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+def extract_pages(executor, path, page_count, reader=read_pages, reader_args=()):
+    # Pages are read in the process pool a few at a time and yielded in order,
+    # with at most MAX_PENDING_TASKS ranges in flight
+    ranges = deque(
+        (start, min(start + PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PAGES_PER_TASK)
+    )
+    pending = deque()
+    while ranges or pending:
+        while ranges and len(pending) < MAX_PENDING_TASKS:
+            pending.append(
+                executor.submit(reader, path, *ranges.popleft(), *reader_args)
+            )
+        for page in pending.popleft().result():
+            yield page
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest_file(path, namespace, on_progress=None, batch_size=UPSERT_BATCH_SIZE):
+    # Extract -> split -> embed and upsert, each stage streaming into the next
+    # through a bounded queue. Batches are embedded and upserted on the upload
+    # workers, at most gate.inflight at a time, so a stalled or rate limited
+    # API holds the pipeline back instead of letting batches pile up.
+    #
+    # Chunks already in the namespace manifest are skipped, so re-uploading a
+    # revised PDF only embeds what changed and a failed upload resumes where
+    # it stopped. Once the whole document went through, chunks it no longer
+    # has are deleted. Returns the chunk counts of the run
+    index = get_vector_index()
+    vector_store = IndexVectorStore(index, get_embeddings(), namespace=namespace)
+    router = get_namespace_router()
+    executor = get_pdf_executor()
+    upload_executor = get_upload_executor()
+    gate = RateLimitGate()
+    manifest = ChunkManifest(namespace)
+    in_index = namespace in (index.describe_index_stats().get("namespaces") or {})
+    ids_in_index = list_chunk_ids(index, namespace) if in_index else None
+    if in_index and not manifest.exists():
+        # The manifest only lives in this host's .cache, e.g. a new host or a
+        # cleared cache. The namespace is never wiped for it: the manifest is
+        # rebuilt from the index, ids that aren't chunks of this document
+        # (like those from before ids were content hashes) are pruned at the
+        # end. An index that can't list its ids is left alone
+        if ids_in_index is None:
+            raise RuntimeError(
+                f"{namespace} is already in the index, but this host has no record"
+                " of its chunks. Delete it from the knowledge base and upload it"
+                " again."
+            )
+        manifest.replace(sorted(ids_in_index))
+    elif not in_index:
+        # Left over from a namespace deleted outside the app
+        manifest.delete()
+    indexed = manifest.load()
+    if ids_in_index is not None:
+        # LocalIndex saves at the end of an upload, so after a crash the
+        # manifest can list chunks the index lost; those are uploaded again
+        indexed &= ids_in_index
+    seen = set()
+    counts = {"pages": 0, "chunks": 0, "uploaded": 0, "skipped": 0, "removed": 0}
+    stage = "uploading"
+
+    def counted(items, key):
+        for item in items:
+            counts[key] += 1
+            yield item
+
+    def new_chunks(chunks):
+        for text in chunks:
+            id = chunk_id(text)
+            if id in seen:
+                continue
+            seen.add(id)
+            if id in indexed:
+                counts["skipped"] += 1
+                continue
+            yield id, text
+
+    def report(page_count, started):
+        if on_progress is None:
+            return
+        elapsed = time.perf_counter() - started
+        done = counts["uploaded"] + counts["skipped"]
+        # The chunk total is not known until the last page is split, so it is
+        # estimated from the pages read so far
+        if counts["pages"]:
+            expected = counts["chunks"] * page_count / counts["pages"]
+        else:
+            expected = 0
+        on_progress(
+            {
+                "stage": stage,
+                "chunks": counts["chunks"],
+                "uploaded": counts["uploaded"],
+                "skipped": counts["skipped"],
+                "pages": counts["pages"],
+                "page_count": page_count,
+                "progress": min(done / expected, 1) if expected else 0,
+                "chunks_per_second": counts["uploaded"] / elapsed if elapsed else 0,
+                "inflight": gate.inflight,
+                "rate_limits": gate.rate_limits,
+            }
+        )
+
+    pending = set()
+    try:
+        started = time.perf_counter()
+        page_count = executor.submit(count_pages, path).result()
+        if SPLITTER == "token":
+            # The workers tokenize the pages in parallel, as they read them
+            pages = extract_pages(
+                executor, path, page_count, read_page_tokens, (TOKEN_ENCODING,)
+            )
+            pages = run_stage(counted(pages, "pages"), PAGE_QUEUE_SIZE)
+            chunks = split_tokens(pages, get_encoding(TOKEN_ENCODING))
+        else:
+            pages = extract_pages(executor, path, page_count)
+            pages = run_stage(counted(pages, "pages"), PAGE_QUEUE_SIZE)
+            chunks = split_pages(pages, get_text_splitter())
+        chunks = counted(chunks, "chunks")
+        batches = run_stage(batched(new_chunks(chunks), batch_size), BATCH_QUEUE_SIZE)
+
+        def collect():
+            done, still_pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.intersection_update(still_pending)
+            for future in done:
+                counts["uploaded"] += future.result()
+            report(page_count, started)
+
+        for batch in batches:
+            while len(pending) >= gate.inflight:
+                collect()
+            pending.add(
+                upload_executor.submit(
+                    upload_batch, vector_store, router, manifest, gate, batch
+                )
+            )
+        while pending:
+            collect()
+
+        if not seen:
+            # A PDF without text never replaces a namespace's content
+            get_namespace_catalog().invalidate()
+            return {"chunks": 0, "uploaded": 0, "skipped": 0, "removed": 0}
+        removed = indexed - seen
+        if removed:
+            stage = "pruning"
+            report(page_count, started)
+            prune_chunks(index, router, namespace, removed)
+            counts["removed"] = len(removed)
+        # Rewrite the append log as just the current document's chunks
+        manifest.replace(sorted(seen))
+        get_namespace_catalog().put(namespace, len(seen))
+        stage = "done"
+        report(page_count, started)
+        return {
+            "chunks": len(seen),
+            "uploaded": counts["uploaded"],
+            "skipped": counts["skipped"],
+            "removed": counts["removed"],
+        }
+    except Exception:
+        # Some batches may be in, the next read refetches the counts
+        get_namespace_catalog().invalidate()
+        raise
+    finally:
+        # On failure, let the batches already sent finish before the cache is
+        # invalidated, so it does not miss any of them
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        # Pinecone has nothing to flush, LocalIndex saves the namespace once
+        # here rather than after every batch
+        flush = getattr(index, "flush", None)
+        if flush is not None:
+            flush(namespace)
+        get_answer_cache().invalidate_namespaces([namespace])
+
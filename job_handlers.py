@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from ingestion_handlers import ingest_file
+from startup_handlers import timed_resource
+
+JOBS_DIR = os.path.join(".cache", "jobs")
+JOBS_DB = os.path.join(JOBS_DIR, "jobs.sqlite3")
+# Ingestions running at once across every session; the rest wait queued
+MAX_CONCURRENT_INGESTIONS = st.secrets.get("ingestion", {}).get(
+    "max_concurrent_jobs", 2
+)
+FINISHED_STATUSES = ("done", "failed")
+
+
+class JobStore:
+    # Durable table of ingestion jobs, so their progress can be polled from any
+    # script run and jobs interrupted by a restart are picked up again
+    def __init__(self, path=JOBS_DB):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    namespace TEXT NOT NULL,
+                    file_name TEXT,
+                    path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """)
+
+    @staticmethod
+    def to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ["progress", "result"]:
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def create(self, namespace, file_name, path):
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO ingestion_jobs"
+                " (namespace, file_name, path, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'queued', ?, ?)",
+                (namespace, file_name, path, now, now),
+            )
+            return cursor.lastrowid
+
+    def update(self, id, **fields):
+        for key in ["progress", "result"]:
+            if key in fields:
+                fields[key] = json.dumps(fields[key])
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"UPDATE ingestion_jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), id),
+            )
+
+    def get(self, id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM ingestion_jobs WHERE id = ?", (id,)
+            ).fetchone()
+        return self.to_dict(row)
+
+    def get_many(self, ids):
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT * FROM ingestion_jobs WHERE id IN ({', '.join('?' for _ in ids)})"
+                " ORDER BY id",
+                list(ids),
+            ).fetchall()
+        return [self.to_dict(row) for row in rows]
+
+    def unfinished(self, namespace=None):
+        query = "SELECT * FROM ingestion_jobs WHERE status NOT IN ('done', 'failed')"
+        params = []
+        if namespace is not None:
+            query += " AND namespace = ?"
+            params.append(namespace)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id", params).fetchall()
+        return [self.to_dict(row) for row in rows]
+
+
+class IngestionJobs:
+    # Runs ingestions on a fixed pool of workers outside of any script run, so
+    # reruns and closed tabs don't abandon them. The pool size is the global
+    # limit on concurrent ingestions; jobs past it stay queued in the store
+    def __init__(self, store, max_jobs=MAX_CONCURRENT_INGESTIONS, directory=JOBS_DIR):
+        self.store = store
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, pdf_bytes, namespace, file_name=None):
+        # Returns the job id and whether it is a new job. A namespace only has
+        # one job at a time, since two would race on its chunk manifest
+        with self.lock:
+            active = self.store.unfinished(namespace)
+            if active:
+                return active[0]["id"], False
+            path = os.path.join(self.directory, f"{uuid.uuid4()}.pdf")
+            with open(path, "wb") as f:
+                f.write(pdf_bytes)
+            id = self.store.create(namespace, file_name, path)
+        self.executor.submit(self.run, id)
+        return id, True
+
+    def run(self, id):
+        job = self.store.get(id)
+        self.store.update(id, status="running")
+        try:
+            result = ingest_file(
+                job["path"],
+                job["namespace"],
+                on_progress=lambda stats: self.store.update(id, progress=stats),
+            )
+        except Exception as e:
+            print("Error=>", e)
+            self.store.update(id, status="failed", error=str(e))
+        else:
+            self.store.update(id, status="done", result=result)
+        finally:
+            if os.path.exists(job["path"]):
+                os.remove(job["path"])
+
+    def resume(self):
+        # Jobs left queued or running by the last process; ingestion skips the
+        # chunks they already uploaded
+        for job in self.store.unfinished():
+            self.executor.submit(self.run, job["id"])
+
+
+@st.cache_resource
+@timed_resource("ingestion_jobs")
+def get_ingestion_jobs():
+    jobs = IngestionJobs(JobStore())
+    jobs.resume()
+    return jobs
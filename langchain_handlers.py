@@ -1,35 +1,168 @@
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Pinecone
 from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain.agents import initialize_agent, Tool
 from langchain.agents import AgentType
+from langchain.schema import Document
 
+import threading
+import weakref
+import contextvars
 import streamlit as st
-import pinecone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-embeddings = OpenAIEmbeddings()
-pinecone.init(
-    api_key=st.secrets["pinecone"]["api_key"],
-    environment=st.secrets["pinecone"]["env"],
-)
-chat = ChatOpenAI(
-    model="gpt-3.5-turbo-16k",
-    temperature=0,
-    streaming=True,
-)
+from embedding_handlers import get_embeddings
+from router_handlers import get_namespace_router
+from startup_handlers import timed_resource
+from trace_handlers import trace_span
+from vector_handlers import IndexVectorStore, get_vector_index
 
+# "agent" lets a ReAct agent pick one namespace tool at a time, "parallel"
+# queries every namespace at once and answers in a single LLM call
+RETRIEVAL_MODE = st.secrets.get("qa", {}).get("retrieval_mode", "agent")
+# In "agent" mode, answer directly when the inquiry clearly matches namespaces
+ROUTE_NAMESPACES = st.secrets.get("qa", {}).get("route_namespaces", True)
+# Hits kept per namespace, and in total after merging all namespaces
+NAMESPACE_TOP_K = 3
+MERGED_TOP_K = 8
+# Agents kept alive by the pool once no session is using them
+MAX_POOLED_AGENTS = 32
+
+
+# Built on first use rather than at import, like the embeddings and the index
+@st.cache_resource
+@timed_resource("chat")
+def get_chat():
+    return ChatOpenAI(
+        model="gpt-3.5-turbo-16k",
+        temperature=0,
+        streaming=True,
+    )
+
+
+# Only for the per-namespace queries. Callers that wait on them must not run
+# on this pool, or a full pool of waiting callers would leave no worker for
+# the queries and deadlock
+@st.cache_resource
+def get_retrieval_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+
+def query_namespace(index, vector, namespace, k=NAMESPACE_TOP_K):
+    with trace_span("vector_query", namespace=namespace, top_k=k) as span:
+        results = index.query(
+            vector=vector, top_k=k, namespace=namespace, include_metadata=True
+        )
+        span.set(matches=len(results["matches"]))
+    hits = []
+    for match in results["matches"]:
+        metadata = dict(match["metadata"])
+        # Chunk text is stored under "text", see IndexVectorStore
+        text = metadata.pop("text", "")
+        metadata["namespace"] = namespace
+        hits.append(
+            (
+                match["score"],
+                Document(
+                    page_content=f"{namespace} franchise:\n{text}", metadata=metadata
+                ),
+            )
+        )
+    return hits
+
+
+def merge_hits(hits_per_namespace, limit=MERGED_TOP_K):
+    # Every namespace keeps its best hit so comparisons never lose a franchise,
+    # the remaining slots go to the best scores overall
+    merged = [hits[0] for hits in hits_per_namespace if hits]
+    rest = [hit for hits in hits_per_namespace for hit in hits[1:]]
+    rest.sort(key=lambda hit: hit[0], reverse=True)
+    merged += rest[: max(limit - len(merged), 0)]
+    merged.sort(key=lambda hit: hit[0], reverse=True)
+    return [document for _, document in merged]
+
+
+def retrieve_parallel(namespaces, inquiry, k=NAMESPACE_TOP_K, limit=MERGED_TOP_K):
+    # One query embedding, fanned out to every namespace concurrently, so the
+    # latency is the slowest namespace rather than the sum of them
+    vector = get_embeddings().embed_query(inquiry)
+    index = get_vector_index()
+    # Each query runs in a copy of this context, so it's traced under the turn
+    futures = [
+        get_retrieval_executor().submit(
+            contextvars.copy_context().run, query_namespace, index, vector, namespace, k
+        )
+        for namespace in namespaces
+    ]
+    hits_per_namespace = []
+    for future in futures:
+        try:
+            hits_per_namespace.append(future.result())
+        except Exception as e:
+            print("Error=>", e)
+    return merge_hits(hits_per_namespace, limit=limit)
+
+
+class ParallelRetrievalQA:
+    # Drop-in for the QA agent: exposes run and one tool per namespace
+    def __init__(self, namespaces):
+        self.namespaces = list(namespaces)
+        self.chain = load_qa_chain(get_chat(), chain_type="stuff")
+        self.tools = [
+            Tool(
+                name=f"{namespace} QA System",
+                func=partial(self.answer, [namespace]),
+                description=f"Answers questions about the {namespace} franchise, retrieved in parallel with the other selected franchises.",
+            )
+            for namespace in self.namespaces
+        ]
+
+    def answer(self, namespaces, inquiry, callbacks=None):
+        documents = retrieve_parallel(namespaces, inquiry)
+        return self.chain.run(
+            input_documents=documents, question=inquiry, callbacks=callbacks
+        )
+
+    def run(self, inquiry, callbacks=None):
+        return self.answer(self.namespaces, inquiry, callbacks=callbacks)
+
+
+class RoutedQAAgent:
+    # Wraps the ReAct agent: inquiries whose embedding clearly matches some
+    # namespace centroids skip the planning round-trips and go straight to
+    # retrieval, the agent only runs when routing is ambiguous
+    def __init__(self, agent, namespaces):
+        self.agent = agent
+        self.tools = agent.tools
+        self.retrieval = ParallelRetrievalQA(namespaces)
+
+    def route(self, inquiry):
+        try:
+            return get_namespace_router().route(
+                get_embeddings().embed_query(inquiry), self.retrieval.namespaces
+            )
+        except Exception as e:
+            print("Error=>", e)
+            return None
+
+    def run(self, inquiry, callbacks=None):
+        routed = self.route(inquiry)
+        if routed is None:
+            return self.agent.run(inquiry, callbacks=callbacks)
+        return self.retrieval.answer(routed, inquiry, callbacks=callbacks)
+
+
+def create_qa_agent(namespaces, mode=RETRIEVAL_MODE):
+    if mode == "parallel":
+        return ParallelRetrievalQA(namespaces)
 
-def create_qa_agent(namespaces):
     tools = []
     for namespace in namespaces:
-        vector_store = Pinecone.from_existing_index(
-            index_name=st.secrets["pinecone"]["index_name"],
-            embedding=embeddings,
-            namespace=namespace,
-        )
+        vector_store = get_agent_pool().vector_store(namespace)
         qa_chain = RetrievalQA.from_chain_type(
-            llm=chat,
+            llm=get_chat(),
             chain_type="stuff",
             retriever=vector_store.as_retriever(search_kwargs={"k": 3}),
         )
@@ -42,8 +175,84 @@ def create_qa_agent(namespaces):
         )
     qa_agent = initialize_agent(
         tools,
-        chat,
+        get_chat(),
         agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
         verbose=True,
     )
+    if ROUTE_NAMESPACES:
+        return RoutedQAAgent(qa_agent, namespaces)
     return qa_agent
+
+
+class AgentLease:
+    # A session's claim on a pooled agent. The claim is released when the
+    # lease is garbage collected, i.e. when the session replaces it or ends
+    def __init__(self, pool, key, entry):
+        self.key = key
+        self.agent = entry["agent"]
+        self.finalizer = weakref.finalize(self, pool.release, key, entry)
+
+    def release(self):
+        self.finalizer()
+
+
+class QAAgentPool:
+    # Process-wide cache of vector store handles per namespace and of agents
+    # per frozen namespace set, so sessions asking about the same franchises
+    # share one set of objects
+    def __init__(self, max_agents=MAX_POOLED_AGENTS):
+        self.max_agents = max_agents
+        self.vector_stores = {}
+        self.agents = OrderedDict()
+        self.lock = threading.RLock()
+
+    def vector_store(self, namespace):
+        with self.lock:
+            if namespace not in self.vector_stores:
+                self.vector_stores[namespace] = IndexVectorStore(
+                    get_vector_index(), get_embeddings(), namespace=namespace
+                )
+            return self.vector_stores[namespace]
+
+    def acquire(self, namespaces):
+        key = frozenset(namespaces)
+        with self.lock:
+            entry = self.agents.get(key)
+        if entry is None:
+            # Built outside the lock so other sessions are not held up; if
+            # two sessions race, the first agent stored wins
+            agent = create_qa_agent(sorted(key))
+            with self.lock:
+                entry = self.agents.setdefault(key, {"agent": agent, "refs": 0})
+        with self.lock:
+            entry["refs"] += 1
+            self.agents.move_to_end(key)
+            self.evict()
+            return AgentLease(self, key, entry)
+
+    def release(self, key, entry):
+        with self.lock:
+            # The entry may have been invalidated and rebuilt since
+            if self.agents.get(key) is entry:
+                entry["refs"] = max(entry["refs"] - 1, 0)
+                self.evict()
+
+    def evict(self):
+        # Least recently used first, never an agent a session still holds
+        idle = [key for key, entry in self.agents.items() if entry["refs"] == 0]
+        while len(self.agents) > self.max_agents and idle:
+            del self.agents[idle.pop(0)]
+
+    def invalidate_namespaces(self, namespaces):
+        # Sessions holding a stale agent keep it until they build a new one
+        namespaces = set(namespaces)
+        with self.lock:
+            for namespace in namespaces:
+                self.vector_stores.pop(namespace, None)
+            for key in [key for key in self.agents if key & namespaces]:
+                del self.agents[key]
+
+
+@st.cache_resource
+def get_agent_pool():
+    return QAAgentPool()
@@ -1,15 +1,25 @@
-import streamlit as st
 import time
+import logging
+
+import streamlit as st
 
-from conversation_handlers import chat_completion_request, execute_function_call
-from connections import fetch_system_prompt, upload_prompt
+from conversation_handlers import stream_chat_completion, execute_function_call
+from connections import fetch_versioned_system_prompt, upload_prompt
+from summary_handlers import build_summarized_context, init_summary
+from context_handlers import count_request_tokens
+from history_handlers import init_conversation, save_conversation, start_conversation
+from job_handlers import get_ingestion_jobs
 from streamlit_handlers import (
     init,
     render_conversation,
     render_qa_agent,
+    StreamRenderer,
 )
+from trace_handlers import activate, deactivate, get_current_span, start_trace
 from langchain.callbacks import StreamlitCallbackHandler
 
+logger = logging.getLogger(__name__)
+
 
 def build_custom_prompt_suffix():
     st.session_state[
@@ -23,7 +33,11 @@ if "functions_instructions" not in st.session_state:
     build_custom_prompt_suffix()
 
 if "custom_prompt" not in st.session_state:
-    st.session_state["custom_prompt"] = fetch_system_prompt()
+    # Not waited for on a cold start, so the page renders while the prompt
+    # loads; sync_system_prompt swaps it in once it's there
+    version, custom_prompt = fetch_versioned_system_prompt(wait=False)
+    st.session_state["custom_prompt_version"] = version
+    st.session_state["custom_prompt"] = custom_prompt or ""
 
 if "functions" not in st.session_state:
     st.session_state["functions"] = [
@@ -50,7 +64,32 @@ if "chat_history" not in st.session_state:
             "content": st.session_state["functions_instructions"]
             + st.session_state["custom_prompt"],
         }
-    ]
+    ] + init_conversation()
+    init_summary()
+
+
+def sync_system_prompt(wait=False):
+    # A new prompt uploaded from another session takes effect here on the next
+    # rerun, keeping the conversation so far
+    version, custom_prompt = fetch_versioned_system_prompt(wait=wait)
+    if custom_prompt is None or version == st.session_state["custom_prompt_version"]:
+        return
+    st.session_state["custom_prompt_version"] = version
+    st.session_state["custom_prompt"] = custom_prompt
+    st.session_state["chat_history"][0] = {
+        "role": "system",
+        "content": st.session_state["functions_instructions"] + custom_prompt,
+    }
+
+
+sync_system_prompt()
+
+# Resumes ingestion jobs interrupted by a restart on the first run of any page,
+# not only once someone uploads another file
+try:
+    get_ingestion_jobs()
+except Exception as e:
+    print("Error=>", e)
 
 
 def reset_chat(custom_prompt):
@@ -62,6 +101,33 @@ def reset_chat(custom_prompt):
             + st.session_state["custom_prompt"],
         }
     ]
+    init_summary()
+    start_conversation()
+
+
+def report_stream_stats(renderer, attempts=None, function_seconds=None):
+    stats = renderer.stats()
+    stats["attempts"] = attempts or []
+    # A function call streams no text, its first token is the call's own
+    if stats["time_to_first_token"] is None:
+        stats["time_to_first_token"] = next(
+            (
+                attempt["time_to_first_token"]
+                for attempt in reversed(stats["attempts"])
+                if attempt["time_to_first_token"] is not None
+            ),
+            None,
+        )
+    stats["function_seconds"] = function_seconds
+    st.session_state["stream_stats"] = stats
+    logger.info("stream stats: %s", stats)
+    get_current_span().set(
+        time_to_first_token=stats["time_to_first_token"],
+        tokens_per_second=stats["tokens_per_second"],
+        render_seconds=stats["render_seconds"],
+        frames=stats["frames"],
+        function_seconds=function_seconds,
+    )
 
 
 def main():
@@ -78,6 +144,9 @@ def main():
                     file_content = uploaded_file.getvalue().decode("utf-8").strip()
                     upload_prompt(file_content)
                     reset_chat(file_content)
+                    st.session_state[
+                        "custom_prompt_version"
+                    ] = fetch_versioned_system_prompt()[0]
 
         render_qa_agent()
 
@@ -89,84 +158,133 @@ def main():
 
     # Check for user input
     if prompt := st.chat_input("Your input"):
-        # Display user message in chat message container
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        # Add user message to chat history
-        st.session_state["chat_history"].append({"role": "user", "content": prompt})
-
-        with st.chat_message("assistant"):
-            # Placeholders
-            message_placeholder = st.empty()
-            function_message = {
-                "content": None,
-                "function_call": {"name": None, "arguments": ""},
-            }
-            full_response = ""
-            # Stream chat completion
-            for chat_response in chat_completion_request(
-                messages=st.session_state["chat_history"],
-                functions=st.session_state["functions"],
-            ):
-                # Streamed chunk
-                delta = chat_response["choices"][0]["delta"]
-
-                # Checks if LLM is responding by itself
-                if "content" in delta and "function_call" not in delta:
-                    full_response += delta.get("content", "")
-                    time.sleep(0.05)
-                    message_placeholder.markdown(full_response + "▌")
-                if chat_response["choices"][0]["finish_reason"] == "stop":
-                    message_placeholder.markdown(full_response)
-                    st.session_state["chat_history"].append(
-                        {"role": "assistant", "content": full_response}
-                    )
+        # Everything the turn does is traced under this span, see pages/traces.py
+        turn = start_trace(
+            "turn",
+            conversation=st.session_state["conversation"]["id"],
+            # Index the user message gets in chat_history
+            position=len(st.session_state["chat_history"]),
+        )
+        turn_context = activate(turn)
+        turn_error = None
+        try:
+            # Display user message in chat message container
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+            # Add user message to chat history
+            st.session_state["chat_history"].append({"role": "user", "content": prompt})
+            # A reply can't go out without the system prompt, wait for it if it
+            # still hasn't loaded
+            sync_system_prompt(wait=True)
 
-                # Checks if LLM needs to call a function to respond
-                if "function_call" in delta:
-                    if "name" in delta["function_call"]:
-                        function_message["function_call"]["name"] = delta[
-                            "function_call"
-                        ]["name"]
-                        function_message["content"] = delta["content"]
-                    if "arguments" in delta["function_call"]:
-                        function_message["function_call"]["arguments"] += delta[
-                            "function_call"
-                        ]["arguments"]
-                if chat_response["choices"][0]["finish_reason"] == "function_call":
-                    st.session_state["chat_history"].append(
-                        {
-                            "role": "assistant",
-                            "content": function_message["content"],
-                            "function_call": function_message["function_call"],
-                        }
+            with st.chat_message("assistant"):
+                # Placeholders
+                message_placeholder = st.empty()
+                renderer = StreamRenderer(message_placeholder)
+                function_message = {
+                    "content": None,
+                    "function_call": {"name": None, "arguments": ""},
+                }
+                # Per-attempt latency metrics, filled in by the streaming client
+                attempts = []
+                # Stream chat completion
+                try:
+                    context = build_summarized_context(
+                        st.session_state["chat_history"],
+                        functions=st.session_state["functions"],
                     )
-                    if st.session_state.get("agent") is not None:
-                        results = execute_function_call(
-                            function_message,
-                            st_callback=StreamlitCallbackHandler(
-                                st.container(),
-                            ),
-                        )
-                        st.markdown(results)
-                    else:
-                        results = "I'm sorry, I don't have an QA Agent to respond to your inquiry."
-                        function_response = ""
-                        for word in results.split(sep=" "):
-                            function_response += word + " "
-                            time.sleep(0.05)
-                            message_placeholder.markdown(function_response + "▌")
-                        message_placeholder.markdown(function_response)
-
-                    st.session_state["chat_history"].append(
-                        {
-                            "role": "function",
-                            "name": function_message["function_call"]["name"],
-                            "content": results,
-                        }
+                    for chat_response in stream_chat_completion(
+                        messages=context,
+                        functions=st.session_state["functions"],
+                        attempts=attempts,
+                        prompt_tokens=count_request_tokens(
+                            context, st.session_state["functions"]
+                        ),
+                    ):
+                        # Streamed chunk
+                        delta = chat_response["choices"][0]["delta"]
+
+                        # Checks if LLM is responding by itself
+                        if "content" in delta and "function_call" not in delta:
+                            renderer.write(delta.get("content", ""))
+                        # "length" is a reply cut off at its max_tokens
+                        if chat_response["choices"][0]["finish_reason"] in (
+                            "stop",
+                            "length",
+                        ):
+                            full_response = renderer.finish()
+                            report_stream_stats(renderer, attempts)
+                            st.session_state["chat_history"].append(
+                                {"role": "assistant", "content": full_response}
+                            )
+
+                        # Checks if LLM needs to call a function to respond
+                        if "function_call" in delta:
+                            if "name" in delta["function_call"]:
+                                function_message["function_call"]["name"] = delta[
+                                    "function_call"
+                                ]["name"]
+                                function_message["content"] = delta["content"]
+                            if "arguments" in delta["function_call"]:
+                                function_message["function_call"]["arguments"] += delta[
+                                    "function_call"
+                                ]["arguments"]
+                        if (
+                            chat_response["choices"][0]["finish_reason"]
+                            == "function_call"
+                        ):
+                            st.session_state["chat_history"].append(
+                                {
+                                    "role": "assistant",
+                                    "content": function_message["content"],
+                                    "function_call": function_message["function_call"],
+                                }
+                            )
+                            function_started = time.perf_counter()
+                            if st.session_state.get("agent") is not None:
+                                results = execute_function_call(
+                                    function_message,
+                                    st_callback=StreamlitCallbackHandler(
+                                        st.container(),
+                                    ),
+                                )
+                                st.markdown(results)
+                            else:
+                                results = "I'm sorry, I don't have an QA Agent to respond to your inquiry."
+                                renderer.write(results)
+                                renderer.finish()
+
+                            st.session_state["chat_history"].append(
+                                {
+                                    "role": "function",
+                                    "name": function_message["function_call"]["name"],
+                                    "content": results,
+                                }
+                            )
+                            report_stream_stats(
+                                renderer,
+                                attempts,
+                                function_seconds=time.perf_counter() - function_started,
+                            )
+                except Exception as e:
+                    print("Error=>", e)
+                    turn_error = e
+                    report_stream_stats(renderer, attempts)
+                    message_placeholder.error(
+                        "Sorry, I couldn't get a response. Please try again."
                     )
 
+            save_conversation()
+        except BaseException as e:
+            # Including Streamlit's rerun and stop, e.g. a new message sent
+            # while this reply streams, so the turn is still exported
+            turn_error = e
+            raise
+        finally:
+            turn.end(turn_error)
+            deactivate(turn_context)
+
 
 if __name__ == "__main__":
     init()
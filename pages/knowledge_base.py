@@ -2,41 +2,83 @@ import streamlit as st
 import time
 from streamlit_tree_select import tree_select
 from streamlit_modal import Modal
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Pinecone
 
 from main import build_custom_prompt_suffix
 from connections import fetch_namespaces, delete_namespaces
-from langchain_handlers import create_qa_agent
-from streamlit_handlers import render_qa_agent
+from job_handlers import FINISHED_STATUSES, get_ingestion_jobs
+from langchain_handlers import get_agent_pool
+from streamlit_handlers import (
+    render_qa_agent,
+    render_ingestion_jobs,
+    render_delete_results,
+)
+
+# Seconds between polls of the job store while uploads are running
+JOB_POLL_SECONDS = 1
 
 
 def build_directory():
-    st.session_state["namespaces"] = fetch_namespaces()
+    try:
+        vector_counts = fetch_namespaces()
+    except Exception as e:
+        print("Error=>", e)
+        st.error("Error: Unable to load resources. Reload the page to try again.")
+        return
+    st.session_state["namespaces"] = list(vector_counts)
     st.session_state["directory"] = [
-        {"label": namespace, "value": namespace}
-        for namespace in st.session_state["namespaces"]
+        {"label": f"{namespace} ({vector_count} chunks)", "value": namespace}
+        for namespace, vector_count in sorted(vector_counts.items())
+    ]
+
+
+def remove_from_directory(namespaces):
+    # Drops deleted namespaces from the directory without refetching it
+    st.session_state["namespaces"] = [
+        namespace
+        for namespace in st.session_state.get("namespaces", [])
+        if namespace not in namespaces
+    ]
+    st.session_state["directory"] = [
+        entry
+        for entry in st.session_state.get("directory", [])
+        if entry["value"] not in namespaces
     ]
 
 
 def delete_resources(namespaces_to_delete):
-    result = delete_namespaces(namespaces_to_delete)
-
-    if result:
-        # Python List Comprehension - Remove namespaces to delete from existing QA Agent
-        updated_agent_namespaces = [
-            x
-            for x in st.session_state["agent_namespaces"]
-            if x not in set(namespaces_to_delete)
-        ]
-        if len(updated_agent_namespaces) > 0:
-            is_agent_updated = create_agent(updated_agent_namespaces)
-            if is_agent_updated:
-                return result
+    total = len(namespaces_to_delete)
+    progress = st.progress(0.0, text=f"Deleting resources: 0/{total}")
+    finished = []
+
+    def on_result(result):
+        finished.append(result)
+        # Pooled agents over the namespace are rebuilt the next time they're needed
+        try:
+            get_agent_pool().invalidate_namespaces([result["namespace"]])
+        except Exception as e:
+            print("Error=>", e)
+        progress.progress(
+            len(finished) / max(total, 1),
+            text=f"Deleting resources: {len(finished)}/{total}",
+        )
+
+    results = delete_namespaces(namespaces_to_delete, on_result=on_result)
+    progress.empty()
+    deleted = {result["namespace"] for result in results if result["deleted"]}
+    remove_from_directory(deleted)
+
+    # Python List Comprehension - Remove namespaces to delete from existing QA Agent
+    updated_agent_namespaces = [
+        x for x in st.session_state["agent_namespaces"] if x not in deleted
+    ]
+    is_agent_updated = False
+    if 0 < len(updated_agent_namespaces) < len(st.session_state["agent_namespaces"]):
+        # Rebuilds the directory too
+        is_agent_updated = create_agent(updated_agent_namespaces)
+    if not is_agent_updated and len(deleted) < total:
+        # The counts of namespaces that failed midway are refetched
         build_directory()
-    return result
+    return results, is_agent_updated
 
 
 def check_directory():
@@ -50,9 +92,11 @@ def check_directory():
 def create_agent(namespaces):
     st.session_state["agent_namespaces"] = namespaces
     try:
-        st.session_state["agent"] = create_qa_agent(
+        # Replacing the previous lease hands its agent back to the pool
+        st.session_state["agent_lease"] = get_agent_pool().acquire(
             st.session_state["agent_namespaces"]
         )
+        st.session_state["agent"] = st.session_state["agent_lease"].agent
         build_directory()
         build_custom_prompt_suffix()
         return True
@@ -62,8 +106,6 @@ def create_agent(namespaces):
 
 
 st.title("🗄️ Remote knowledge base")
-if "namespaces" not in st.session_state and "directory" not in st.session_state:
-    build_directory()
 
 if "directory_data" not in st.session_state:
     st.session_state["directory_data"] = {}
@@ -74,6 +116,10 @@ if "agent_namespaces" not in st.session_state:
 if "agent" not in st.session_state:
     st.session_state["agent"] = None
 
+if "ingestion_jobs" not in st.session_state:
+    st.session_state["ingestion_jobs"] = []
+    st.session_state["finished_ingestion_jobs"] = set()
+
 if (
     st.session_state["agent"] is not None
     and "The user can make questions about the following franchises: "
@@ -101,52 +147,32 @@ with st.form("pdf_upload2", clear_on_submit=True):
     submitted = st.form_submit_button("Submit")
 
     if submitted and franchise_name is not None:
-        if (
-            all(part.isalpha() for part in franchise_name.split(sep=" "))
-            and franchise_name not in st.session_state["namespaces"]
-        ):
+        if all(part.isalpha() for part in franchise_name.split(sep=" ")):
             if pdf is not None:
-                pdf_reader = PdfReader(pdf)
-                chunks = []
-                with st.spinner("Preparing content 🚧 ..."):
-                    text = ""
-                    for page in pdf_reader.pages:
-                        text += page.extract_text()
-                    if text != "":
-                        text_splitter = RecursiveCharacterTextSplitter(
-                            chunk_size=1000, chunk_overlap=200, length_function=len
-                        )
-                        chunks = text_splitter.split_text(text=text)
-                        st.success(f"✅ Content ready!")
-
-                    else:
-                        st.error("Invalid PDF file. PDF file does not have text.")
-                with st.spinner("Uploading content 🚧 ..."):
-                    # vectors = vector_store.add_texts(
-                    #     texts=chunks,
-                    #     namespace=franchise_name,
-                    #     batch_size=80,
-                    # )
-                    embeddings = OpenAIEmbeddings()
-                    temp_vector_store = Pinecone.from_texts(
-                        texts=chunks,
-                        embedding=embeddings,
-                        batch_size=128,
-                        index_name=st.secrets["pinecone"]["index_name"],
-                        namespace=franchise_name,
+                job_id, is_new_job = get_ingestion_jobs().submit(
+                    pdf.getvalue(), franchise_name, file_name=pdf.name
+                )
+                if job_id not in st.session_state["ingestion_jobs"]:
+                    st.session_state["ingestion_jobs"].append(job_id)
+                if not is_new_job:
+                    st.warning(
+                        f"**{franchise_name}** is already being uploaded. Submit again once it finishes."
                     )
-
-                    build_directory()
-                    st.success(f"✅ File uploaded successfully!")
             else:
                 st.error("No PDF file selected. Please upload one.")
         else:
             st.error(
-                f"Invalid name: **{franchise_name}**. Franchise Name already taken or has numbers and/or special characters."
+                f"Invalid name: **{franchise_name}**. Franchise Name has numbers and/or special characters."
             )
 
+jobs_placeholder = st.empty()
+
 st.subheader("Select your resources")
-st.session_state["directory_data"] = tree_select(st.session_state["directory"])
+# Loaded down here so everything above renders without waiting on the index
+if "namespaces" not in st.session_state and "directory" not in st.session_state:
+    with st.spinner("Loading resources..."):
+        build_directory()
+st.session_state["directory_data"] = tree_select(st.session_state.get("directory", []))
 
 delete_namespaces_col, create_agent_col = st.columns([0.3, 0.7])
 
@@ -174,15 +200,22 @@ if delete_namespaces_modal.is_open():
         col1, col2 = st.columns([0.3, 0.7])
         with col1:
             if st.button("Yes"):
-                if (
-                    delete_resources(st.session_state["directory_data"]["checked"])
-                    == True
-                ):
-                    st.success("Resources deleted and QA Agent updated successfully!")
+                results, is_agent_updated = delete_resources(
+                    st.session_state["directory_data"]["checked"]
+                )
+                render_delete_results(results)
+                if all(result["deleted"] for result in results):
+                    st.success(
+                        "Resources deleted and QA Agent updated successfully!"
+                        if is_agent_updated
+                        else "Resources deleted successfully!"
+                    )
                     time.sleep(1)
                     delete_namespaces_modal.close()
                 else:
-                    st.error("Error: Unable to delete resources.")
+                    st.error(
+                        "Error: Unable to delete some resources. Select them and try again."
+                    )
 
         with col2:
             if st.button("No"):
@@ -218,3 +251,19 @@ with st.sidebar:
     render_qa_agent()
 
 st.session_state["current_page"] = "knowledge_base"
+
+# Polls last, so the rest of the page is usable while uploads run. Any widget
+# interaction reruns the script and only restarts this loop, the jobs go on
+while st.session_state["ingestion_jobs"]:
+    jobs = get_ingestion_jobs().store.get_many(st.session_state["ingestion_jobs"])
+    with jobs_placeholder.container():
+        st.subheader("Uploads")
+        render_ingestion_jobs(jobs)
+    finished = {job["id"] for job in jobs if job["status"] in FINISHED_STATUSES}
+    if finished - st.session_state["finished_ingestion_jobs"]:
+        st.session_state["finished_ingestion_jobs"] |= finished
+        build_directory()
+        st.experimental_rerun()
+    if len(finished) == len(jobs):
+        break
+    time.sleep(JOB_POLL_SECONDS)
@@ -0,0 +1,159 @@
+import json
+from datetime import datetime
+
+import altair as alt
+import pandas as pd
+import streamlit as st
+
+from trace_handlers import get_trace_exporter, load_traces, to_otlp
+
+# Most recent turns read from the trace file
+MAX_TRACES = 100
+
+
+def waterfall_rows(spans):
+    # One row per span, depth first from the turn, siblings in start order.
+    # Spans whose parent hasn't been written (yet) are shown at the top level
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_span_id"], []).append(span)
+    span_ids = {span["span_id"] for span in spans}
+    started = min(span["start_time_unix_nano"] for span in spans)
+    rows = []
+
+    def visit(span, depth):
+        attributes = span["attributes"]
+        rows.append(
+            {
+                "span": f"{len(rows) + 1:>2}. {'  ' * depth}{span['name']}",
+                "kind": span["name"].split(" ")[0].split(".")[0],
+                "start_ms": (span["start_time_unix_nano"] - started) / 1e6,
+                "end_ms": (span["end_time_unix_nano"] - started) / 1e6,
+                "duration_ms": (
+                    span["end_time_unix_nano"] - span["start_time_unix_nano"]
+                )
+                / 1e6,
+                "prompt_tokens": attributes.get("prompt_tokens"),
+                "completion_tokens": attributes.get("completion_tokens"),
+                "cost_usd": attributes.get("cost_usd"),
+                "status": span["status"].get("message") or span["status"]["code"],
+                "attributes": json.dumps(attributes, default=str),
+            }
+        )
+        for child in sorted(
+            children.get(span["span_id"], []),
+            key=lambda child: child["start_time_unix_nano"],
+        ):
+            visit(child, depth + 1)
+
+    for span in sorted(
+        [span for span in spans if span["parent_span_id"] not in span_ids],
+        key=lambda span: span["start_time_unix_nano"],
+    ):
+        visit(span, 0)
+    return rows
+
+
+def summarize_trace(spans):
+    root = min(spans, key=lambda span: span["start_time_unix_nano"])
+    priced = [span["attributes"] for span in spans if "cost_usd" in span["attributes"]]
+    return {
+        "started": datetime.fromtimestamp(root["start_time_unix_nano"] / 1e9),
+        "duration_ms": (
+            max(span["end_time_unix_nano"] for span in spans)
+            - root["start_time_unix_nano"]
+        )
+        / 1e6,
+        "spans": len(spans),
+        "prompt_tokens": sum(
+            attributes.get("prompt_tokens") or 0 for attributes in priced
+        ),
+        "completion_tokens": sum(
+            attributes.get("completion_tokens") or 0 for attributes in priced
+        ),
+        "cost_usd": sum(attributes["cost_usd"] for attributes in priced),
+        "conversation": root["attributes"].get("conversation"),
+        "position": root["attributes"].get("position"),
+        "status": root["status"]["code"],
+    }
+
+
+st.title("⏱️ Turn traces")
+st.caption(
+    "Where each chat turn's time and tokens went: the completion stream, function calls, the agent's LLM calls, embeddings and vector queries."
+)
+
+# Counts for this server process, since it started
+exporter_stats = get_trace_exporter().stats()
+if exporter_stats["dropped"] or exporter_stats["failed"]:
+    st.warning(
+        f"{exporter_stats['dropped']} spans were dropped with the trace buffer full "
+        f"and {exporter_stats['failed']} couldn't be written since the server started, "
+        "so some turns below are missing spans."
+    )
+
+traces = load_traces(limit=MAX_TRACES)
+if not traces:
+    st.info("No traces yet. Chat on the main page to record some.")
+    st.stop()
+
+summaries = [summarize_trace(spans) for spans in reversed(traces)]
+st.subheader("Recent turns")
+st.dataframe(pd.DataFrame(summaries), use_container_width=True, hide_index=True)
+
+st.subheader("Waterfall")
+selected = st.selectbox(
+    "Turn",
+    range(len(summaries)),
+    format_func=lambda index: f"{summaries[index]['started']:%Y-%m-%d %H:%M:%S} · "
+    f"{summaries[index]['duration_ms']:.0f} ms · "
+    f"{summaries[index]['conversation'] or '-'} #{summaries[index]['position']}",
+)
+spans = list(reversed(traces))[selected]
+summary = summaries[selected]
+
+duration_col, spans_col, tokens_col, cost_col = st.columns(4)
+duration_col.metric("Duration", f"{summary['duration_ms']:.0f} ms")
+spans_col.metric("Spans", summary["spans"])
+tokens_col.metric(
+    "Tokens", f"{summary['prompt_tokens']} + {summary['completion_tokens']}"
+)
+cost_col.metric("Cost", f"${summary['cost_usd']:.4f}")
+
+rows = pd.DataFrame(waterfall_rows(spans))
+st.altair_chart(
+    alt.Chart(rows)
+    .mark_bar()
+    .encode(
+        x=alt.X("start_ms:Q", title="ms since the turn started"),
+        x2="end_ms:Q",
+        y=alt.Y("span:N", sort=None, title=None),
+        color=alt.Color("kind:N", title=None),
+        tooltip=[
+            "span",
+            alt.Tooltip("duration_ms:Q", format=".1f"),
+            "prompt_tokens",
+            "completion_tokens",
+            alt.Tooltip("cost_usd:Q", format=".5f"),
+            "status",
+            "attributes",
+        ],
+    )
+    .properties(height=max(24 * len(rows), 120)),
+    use_container_width=True,
+)
+st.dataframe(rows.drop(columns=["kind"]), use_container_width=True, hide_index=True)
+
+jsonl_col, otlp_col = st.columns(2)
+jsonl_col.download_button(
+    "Download spans (JSONL)",
+    "".join(json.dumps(span) + "\n" for span in spans),
+    file_name=f"trace-{spans[0]['trace_id']}.jsonl",
+    mime="application/jsonl",
+)
+otlp_col.download_button(
+    "Download OTLP JSON",
+    json.dumps(to_otlp(spans)),
+    file_name=f"trace-{spans[0]['trace_id']}.otlp.json",
+    mime="application/json",
+)
@@ -0,0 +1,40 @@
+import tiktoken
+from PyPDF2 import PdfReader
+
+# Runs in the PDF worker processes, so it only imports PyPDF2 and tiktoken.
+# Each worker keeps the last document it opened, since consecutive tasks read
+# page ranges of the same file
+_reader = None
+_encodings = {}
+
+
+def open_reader(path):
+    global _reader
+    if _reader is None or _reader[0] != path:
+        _reader = (path, PdfReader(path))
+    return _reader[1]
+
+
+def get_encoding(encoding_name):
+    if encoding_name not in _encodings:
+        _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return _encodings[encoding_name]
+
+
+def count_pages(path):
+    return len(open_reader(path).pages)
+
+
+def read_pages(path, start, stop):
+    pages = open_reader(path).pages
+    return [pages[number].extract_text() or "" for number in range(start, stop)]
+
+
+def encode_pages(texts, encoding_name):
+    # encode_ordinary, so text like "<|endoftext|>" in a PDF is not rejected
+    encoding = get_encoding(encoding_name)
+    return [encoding.encode_ordinary(text) for text in texts]
+
+
+def read_page_tokens(path, start, stop, encoding_name):
+    return encode_pages(read_pages(path, start, stop), encoding_name)
@@ -0,0 +1,114 @@
+import time
+import select
+import threading
+
+import psycopg2
+import streamlit as st
+
+from db_handlers import execute_prepared, get_db_pool
+from startup_handlers import timed_resource
+
+# upload_prompt notifies this channel in the transaction that writes a prompt
+PROMPT_CHANNEL = "system_prompt"
+# While listening, the version is still checked this often, in case a
+# notification was missed across a reconnect
+PROMPT_CHECK_SECONDS = 60
+# Without a listening connection the version is polled instead, and listening
+# is retried after PROMPT_RELISTEN_SECONDS
+PROMPT_POLL_SECONDS = 1
+PROMPT_RELISTEN_SECONDS = 30
+
+
+def load_system_prompt(connection):
+    with connection.cursor() as cur:
+        execute_prepared(cur, "fetch_system_prompt")
+        row = cur.fetchone()
+        # Replies must never go out without the prompt, so fail loudly
+        if row is None or row[3] is None:
+            raise RuntimeError("The system_prompt table has no prompt")
+        # xmin changes with every write to the row, so it versions the prompt
+        return row[0], row[3]
+
+
+def load_system_prompt_version(connection):
+    with connection.cursor() as cur:
+        execute_prepared(cur, "fetch_system_prompt_version")
+        return cur.fetchone()[0]
+
+
+class PromptCache:
+    # Process-wide copy of the system prompt and its version. New sessions read
+    # it from memory, and a listener thread reloads it as soon as Postgres
+    # notifies that another process or session wrote a new one
+    def __init__(self, pool, connect_kwargs):
+        self.pool = pool
+        self.connect_kwargs = connect_kwargs
+        self.version = None
+        self.content = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        version, content = self.pool.run(load_system_prompt)
+        with self.lock:
+            self.version, self.content = version, content
+
+    def check(self):
+        # One tiny query, the prompt itself is only fetched when it changed
+        if self.pool.run(load_system_prompt_version) != self.version:
+            self.load()
+
+    def get(self, wait=True):
+        # Without waiting, the listener thread does the first load and this
+        # returns (None, None) until it has. Waiting raises if it can't load
+        if wait and self.version is None:
+            self.load()
+        with self.lock:
+            return self.version, self.content
+
+    def start(self):
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(**self.connect_kwargs)
+                connection.autocommit = True
+                with connection.cursor() as cur:
+                    cur.execute(f"LISTEN {PROMPT_CHANNEL}")
+                # Catch up on anything written while not listening
+                self.check()
+                while True:
+                    readable, _, _ = select.select(
+                        [connection], [], [], PROMPT_CHECK_SECONDS
+                    )
+                    if not readable:
+                        self.check()
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        self.load()
+            except Exception as e:
+                print("Error=>", e)
+            finally:
+                if connection is not None:
+                    connection.close()
+            self.poll(PROMPT_RELISTEN_SECONDS)
+
+    def poll(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                self.check()
+            except Exception as e:
+                print("Error=>", e)
+            time.sleep(PROMPT_POLL_SECONDS)
+
+
+@st.cache_resource
+@timed_resource("prompt_cache")
+def get_prompt_cache():
+    prompt_cache = PromptCache(get_db_pool(), st.secrets["postgres"])
+    prompt_cache.start()
+    return prompt_cache
@@ -0,0 +1,102 @@
+import os
+import threading
+
+import numpy as np
+import streamlit as st
+
+CENTROIDS_DIR = os.path.join(".cache", "centroids")
+# Below this similarity the inquiry is not clearly about any namespace
+MIN_ROUTE_SCORE = 0.75
+# Namespaces scoring within this margin of the best one are all routed to
+ROUTE_MARGIN = 0.03
+# Past this many close namespaces the inquiry is ambiguous, let the agent plan
+MAX_ROUTED_NAMESPACES = 2
+
+
+class NamespaceRouter:
+    # Keeps a running sum of chunk embeddings per namespace, so its centroid
+    # can be updated as chunks are added or removed, and picks the namespaces
+    # an inquiry is about by cosine similarity to those centroids
+    def __init__(self, directory=CENTROIDS_DIR):
+        self.directory = directory
+        self.sums = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".npz"):
+                data = np.load(os.path.join(directory, file_name))
+                namespace = file_name[: -len(".npz")]
+                self.sums[namespace] = data["sum"]
+                self.counts[namespace] = int(data["count"])
+
+    def path(self, namespace):
+        return os.path.join(self.directory, f"{namespace}.npz")
+
+    def save(self, namespace):
+        np.savez(
+            self.path(namespace),
+            sum=self.sums[namespace],
+            count=self.counts[namespace],
+        )
+
+    def add(self, namespace, vectors, sign=1):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        with self.lock:
+            total = sign * vectors.sum(axis=0)
+            if namespace in self.sums:
+                self.sums[namespace] = self.sums[namespace] + total
+                self.counts[namespace] += sign * len(vectors)
+            else:
+                self.sums[namespace] = total
+                self.counts[namespace] = sign * len(vectors)
+            self.save(namespace)
+
+    def subtract(self, namespace, vectors):
+        self.add(namespace, vectors, sign=-1)
+
+    def remove(self, namespaces):
+        with self.lock:
+            for namespace in namespaces:
+                self.sums.pop(namespace, None)
+                self.counts.pop(namespace, None)
+                if os.path.exists(self.path(namespace)):
+                    os.remove(self.path(namespace))
+
+    def scores(self, vector, namespaces):
+        # None when any namespace has no centroid yet (ingested before routing)
+        with self.lock:
+            if any(self.counts.get(namespace, 0) <= 0 for namespace in namespaces):
+                return None
+            centroids = np.stack([self.sums[namespace] for namespace in namespaces])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        vector = np.asarray(vector, dtype=np.float32)
+        return centroids @ (vector / np.linalg.norm(vector))
+
+    def route(self, vector, namespaces):
+        # Returns the namespaces to query directly, or None when the agent
+        # should decide
+        namespaces = list(namespaces)
+        if len(namespaces) == 1:
+            return namespaces
+        scores = self.scores(vector, namespaces) if namespaces else None
+        if scores is None:
+            return None
+        best = float(scores.max())
+        if best < MIN_ROUTE_SCORE:
+            return None
+        routed = [
+            namespace
+            for namespace, score in zip(namespaces, scores)
+            if score >= best - ROUTE_MARGIN
+        ]
+        if len(routed) > MAX_ROUTED_NAMESPACES:
+            return None
+        return routed
+
+
+@st.cache_resource
+def get_namespace_router():
+    return NamespaceRouter()
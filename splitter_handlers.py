@@ -0,0 +1,78 @@
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Splitters for the ingestion pipeline. Kept free of streamlit and the vector
+# backends, so benchmarks/bench_splitter.py can run them on their own
+
+# Characters of text split at once; the unfinished tail carries over
+SPLIT_WINDOW = 8000
+# Encoding of both text-embedding-ada-002 and gpt-3.5-turbo
+TOKEN_ENCODING = "cl100k_base"
+# Up to MERGED_TOP_K = 8 chunks are stuffed into a retrieval prompt
+CHUNK_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 48
+# How far a chunk end may move back to avoid splitting a word
+WORD_BOUNDARY_LOOKBACK = 16
+
+
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, length_function=len
+    )
+
+
+def split_pages(pages, text_splitter, window=SPLIT_WINDOW):
+    # Splits as pages arrive instead of after the whole document is read. The
+    # last chunk of each window is unfinished, so it is carried into the next
+    # one, which keeps chunks and overlaps across page boundaries intact
+    buffer = ""
+    for text in pages:
+        buffer = f"{buffer}\n{text}" if buffer else text
+        if len(buffer) >= window:
+            chunks = text_splitter.split_text(buffer)
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
+    if buffer.strip():
+        yield from text_splitter.split_text(buffer)
+
+
+def chunk_end(encoding, tokens, end, lookback=WORD_BOUNDARY_LOOKBACK):
+    # Moves the cut back to the nearest token starting with whitespace, so the
+    # chunk ends on a whole word when one is close
+    for position in range(end, max(end - lookback, 0), -1):
+        if encoding.decode_single_token_bytes(tokens[position])[:1].isspace():
+            return position
+    return end
+
+
+def split_tokens(
+    pages, encoding, chunk_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS
+):
+    # Pages arrive already tokenized by the PDF workers, so chunks are token
+    # slices of a running buffer, with no re-measuring or re-splitting. Only
+    # the tail that has not filled a chunk yet is carried across pages
+    separator = encoding.encode_ordinary("\n")
+    buffer = []
+    emitted = False
+    # Tokens at the start of the buffer already sent as the last chunk's end
+    carried = 0
+    for tokens in pages:
+        if buffer:
+            buffer.extend(separator)
+        buffer.extend(tokens)
+        while len(buffer) > chunk_tokens:
+            end = chunk_end(encoding, buffer, chunk_tokens)
+            text = encoding.decode(buffer[:end]).strip()
+            if text:
+                yield text
+                emitted = True
+            # The next chunk starts on a word too, overlapping a little more
+            start = max(chunk_end(encoding, buffer, end - overlap), 1)
+            carried = max(end - start, 0)
+            del buffer[:start]
+    # The tail is only a chunk of its own if it adds text the last chunk
+    # didn't have; the carried part can be longer than `overlap` once snapped
+    # to a word, and what follows it can be just whitespace
+    if buffer and (encoding.decode(buffer[carried:]).strip() or not emitted):
+        text = encoding.decode(buffer).strip()
+        if text:
+            yield text
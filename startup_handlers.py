@@ -0,0 +1,36 @@
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+# How long each resource took to build in this process, in the order they were
+# built. benchmarks/bench_startup.py reports these next to the import times
+resource_timings = OrderedDict()
+resource_timings_lock = threading.Lock()
+
+
+def timed_resource(name):
+    # Goes under @st.cache_resource, so only an actual build is timed and a
+    # failed one, e.g. an unreachable backend, is timed again on the next try
+    def decorate(provider):
+        @wraps(provider)
+        def build(*args, **kwargs):
+            started = time.perf_counter()
+            error = None
+            try:
+                return provider(*args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                seconds = time.perf_counter() - started
+                with resource_timings_lock:
+                    resource_timings[name] = {
+                        "seconds": seconds,
+                        "error": repr(error) if error is not None else None,
+                    }
+                print(f"startup timing=> {name}: {seconds * 1000:.1f} ms")
+
+        return build
+
+    return decorate
@@ -1,6 +1,8 @@
 import streamlit as st
 from dotenv import load_dotenv
 import os
+import time
+from functools import lru_cache
 
 
 @st.cache_data(ttl=60 * 60)
@@ -17,14 +19,80 @@ def init():
         )
 
 
-def render_conversation():
-    for message in st.session_state["chat_history"][1:]:
-        if message["content"] is not None:
-            with st.chat_message(
-                name=message["role"],
-                avatar="https://raw.githubusercontent.com/morghan/chatGPT-clone/main/icons/database.png" if message["role"] == "function" else None,
+# Messages always rendered as chat messages; older ones are paged in on demand
+RECENT_MESSAGES = 12
+EARLIER_PAGE_MESSAGES = 20
+FUNCTION_AVATAR = (
+    "https://raw.githubusercontent.com/morghan/chatGPT-clone/main/icons/database.png"
+)
+TRANSCRIPT_LABELS = {
+    "user": "🧑 **You**",
+    "assistant": "🤖 **Assistant**",
+    "function": "🗄️ **Knowledge base**",
+}
+
+
+@lru_cache(maxsize=256)
+def transcript_block(messages):
+    # `messages` is a tuple of (role, content) pairs, so a page of earlier
+    # messages is joined once and reused on every rerun after that
+    return "\n\n---\n\n".join(
+        f"{TRANSCRIPT_LABELS.get(role, role)}\n\n{content}"
+        for role, content in messages
+    )
+
+
+def show_earlier_messages():
+    st.session_state["earlier_pages"] = st.session_state.get("earlier_pages", 0) + 1
+
+
+def render_conversation(recent_messages=RECENT_MESSAGES):
+    # Renders the latest `recent_messages` messages, and pages of earlier ones
+    # only once asked for, so a rerun costs about the same however long the
+    # conversation is. None renders every message as a chat message
+    messages = [
+        message
+        for message in st.session_state["chat_history"][1:]
+        if message["content"] is not None
+    ]
+    if recent_messages is None or len(messages) <= recent_messages:
+        earlier, recent = [], messages
+    else:
+        earlier, recent = messages[:-recent_messages], messages[-recent_messages:]
+
+    if earlier:
+        # Pages are counted from the start of the conversation, so every full
+        # page keeps its messages, and its cached block, as the chat grows
+        page_starts = list(range(0, len(earlier), EARLIER_PAGE_MESSAGES))
+        pages = st.session_state.get("earlier_pages", 0)
+        shown_starts = page_starts[max(len(page_starts) - pages, 0) :] if pages else []
+        hidden = shown_starts[0] if shown_starts else len(earlier)
+        if hidden:
+            st.button(
+                f"Show earlier messages ({hidden} hidden)",
+                on_click=show_earlier_messages,
+            )
+        if shown_starts:
+            with st.expander(
+                f"Earlier messages ({len(earlier) - hidden})", expanded=True
             ):
-                st.markdown(message["content"])
+                for start in shown_starts:
+                    page = earlier[start : start + EARLIER_PAGE_MESSAGES]
+                    st.markdown(
+                        transcript_block(
+                            tuple(
+                                (message["role"], message["content"])
+                                for message in page
+                            )
+                        )
+                    )
+
+    for message in recent:
+        with st.chat_message(
+            name=message["role"],
+            avatar=FUNCTION_AVATAR if message["role"] == "function" else None,
+        ):
+            st.markdown(message["content"])
 
 
 def render_qa_agent():
@@ -35,3 +103,124 @@ def render_qa_agent():
                 st.write(f"**Tool description**: {tool.description}")
                 if index != len(st.session_state["agent"].tools) - 1:
                     st.divider()
+
+
+def render_ingestion_jobs(jobs):
+    for job in jobs:
+        progress = job["progress"] or {}
+        st.write(f"**{job['namespace']}** ({job['file_name'] or 'PDF'})")
+        if job["status"] == "queued":
+            st.info("⏳ Waiting for a free ingestion worker...")
+        elif job["status"] == "running":
+            page_count = progress.get("page_count") or 0
+            pages = progress.get("pages", 0)
+            st.progress(
+                pages / page_count if page_count else 0,
+                text=f"Reading pages: {pages}/{page_count}",
+            )
+            st.progress(
+                progress.get("progress", 0),
+                text=f"Embedding and uploading: {progress.get('uploaded', 0)} chunks "
+                f"uploaded, {progress.get('skipped', 0)} unchanged "
+                f"({progress.get('chunks_per_second', 0):.1f} chunks/sec)",
+            )
+            if progress.get("stage") == "pruning":
+                st.caption("Removing chunks that are no longer in the PDF...")
+        elif job["status"] == "done" and job["result"]["chunks"]:
+            result = job["result"]
+            st.success(
+                f"✅ File uploaded successfully! {result['uploaded']} new, "
+                f"{result['skipped']} unchanged and {result['removed']} removed chunks."
+            )
+        elif job["status"] == "done":
+            st.error("Invalid PDF file. PDF file does not have text.")
+        else:
+            st.error(
+                "Error: Unable to upload the PDF file. Submit it again to resume the upload."
+            )
+
+
+def render_delete_results(results):
+    for result in results:
+        if result["deleted"]:
+            st.write(
+                f"✅ **{result['namespace']}** deleted in {result['seconds']:.1f}s"
+                + (f", but: {result['error']}" if result["error"] else "")
+            )
+        else:
+            st.write(
+                f"❌ **{result['namespace']}** not deleted after {result['seconds']:.1f}s: {result['error']}"
+            )
+
+
+class StreamRenderer:
+    # Buffers streamed deltas and repaints the placeholder at most once per frame
+    # (every `frame_interval` seconds or every `frame_tokens` deltas, whichever
+    # comes first), so rendering never throttles the model.
+    def __init__(self, placeholder, frame_interval=0.05, frame_tokens=32, cursor="▌"):
+        self.placeholder = placeholder
+        self.frame_interval = frame_interval
+        self.frame_tokens = frame_tokens
+        self.cursor = cursor
+        self.parts = []
+        self.tokens = 0
+        self.pending_tokens = 0
+        self.frames = 0
+        self.render_seconds = 0.0
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.last_flush_at = self.started_at
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def write(self, delta):
+        if not delta:
+            return
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.parts.append(delta)
+        self.tokens += 1
+        self.pending_tokens += 1
+        if (
+            self.pending_tokens >= self.frame_tokens
+            or now - self.last_flush_at >= self.frame_interval
+        ):
+            self.flush()
+
+    def flush(self, final=False):
+        start = time.perf_counter()
+        self.placeholder.markdown(self.text if final else self.text + self.cursor)
+        self.last_flush_at = time.perf_counter()
+        self.render_seconds += self.last_flush_at - start
+        self.pending_tokens = 0
+        self.frames += 1
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        self.flush(final=True)
+        return self.text
+
+    def stats(self):
+        end = self.finished_at or time.perf_counter()
+        ttft = (
+            self.first_token_at - self.started_at
+            if self.first_token_at is not None
+            else None
+        )
+        generation_seconds = (
+            end - self.first_token_at if self.first_token_at is not None else 0.0
+        )
+        return {
+            "time_to_first_token": ttft,
+            "tokens": self.tokens,
+            "tokens_per_second": (
+                self.tokens / generation_seconds if generation_seconds > 0 else None
+            ),
+            "frames": self.frames,
+            "render_seconds": self.render_seconds,
+            "total_seconds": end - self.started_at,
+        }
@@ -0,0 +1,129 @@
+import streamlit as st
+import openai
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from conversation_handlers import GPT_MODEL
+from context_handlers import build_context_window, recent_window_start
+from trace_handlers import trace_span
+
+# Max number of evicted messages folded into the summary per background job
+SUMMARY_BATCH_MESSAGES = 20
+# Tokens of the most recent turns sent verbatim, older turns are summarized
+RECENT_WINDOW_TOKENS = st.secrets.get("chat", {}).get("recent_window_tokens", 3000)
+
+SUMMARY_PROMPT = """Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.
+Keep every fact the user has shared about themselves (background, finances, goals, preferences) and every franchise discussed, since the interview continues from this summary.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{lines}
+
+New summary:"""
+
+
+@st.cache_resource
+def get_summary_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+
+def init_summary():
+    st.session_state["chat_summary"] = {
+        "content": None,
+        # Number of chat_history messages (after the system prompt) folded in
+        "summarized": 0,
+        "job": None,
+    }
+
+
+def format_lines(messages):
+    lines = []
+    for message in messages:
+        if message.get("function_call"):
+            lines.append(
+                f"assistant called {message['function_call']['name']}"
+                f"({message['function_call']['arguments']})"
+            )
+        elif message["role"] == "function":
+            lines.append(f"function {message['name']}: {message['content']}")
+        elif message["content"]:
+            lines.append(f"{message['role']}: {message['content']}")
+    return "\n".join(lines)
+
+
+def summarize(summary, messages, model=GPT_MODEL):
+    # Runs in the summary executor, so it must not touch st.session_state
+    with trace_span("summary", model=model, messages=len(messages)) as span:
+        response = openai.ChatCompletion.create(
+            model=model,
+            temperature=0,
+            messages=[
+                {
+                    "role": "user",
+                    "content": SUMMARY_PROMPT.format(
+                        summary=summary or "", lines=format_lines(messages)
+                    ),
+                }
+            ],
+        )
+        span.set(
+            prompt_tokens=response["usage"]["prompt_tokens"],
+            completion_tokens=response["usage"]["completion_tokens"],
+        )
+    return response["choices"][0]["message"]["content"].strip()
+
+
+def collect_summary(state):
+    job = state["job"]
+    if job is None or not job["future"].done():
+        return
+    state["job"] = None
+    try:
+        state["content"] = job["future"].result()
+        state["summarized"] = job["summarized"]
+    except Exception as e:
+        print("Error=>", e)
+
+
+def schedule_summary(state, messages, evicted):
+    # `evicted` is the number of messages after the system prompt that are
+    # older than the recent window; fold the next batch of them in
+    if state["job"] is not None or evicted <= state["summarized"]:
+        return
+    start = state["summarized"]
+    end = min(evicted, start + SUMMARY_BATCH_MESSAGES)
+    # Run in a copy of this context, so the summary is traced under the turn
+    # that scheduled it
+    future = get_summary_executor().submit(
+        contextvars.copy_context().run,
+        summarize,
+        state["content"],
+        messages[1 + start : 1 + end],
+    )
+    state["job"] = {"future": future, "summarized": end}
+
+
+def build_summarized_context(messages, functions=None):
+    if "chat_summary" not in st.session_state:
+        init_summary()
+    state = st.session_state["chat_summary"]
+
+    with trace_span("context", messages=len(messages)) as span:
+        collect_summary(state)
+        window = build_context_window(
+            messages,
+            functions=functions,
+            summary=state["content"],
+            summarized=state["summarized"],
+        )
+        live = len(window) - (2 if state["content"] else 1)
+        # Older than the recent window, or already trimmed out of the full one
+        evicted = max(
+            recent_window_start(messages, RECENT_WINDOW_TOKENS),
+            len(messages) - 1 - live,
+        )
+        schedule_summary(state, messages, evicted)
+        span.set(window_messages=len(window), summarized=state["summarized"])
+    return window
@@ -0,0 +1,77 @@
+import time
+import asyncio
+import unittest
+from unittest import mock
+
+import conversation_handlers
+from conversation_handlers import stream_chat_completion
+
+
+class FakeStream:
+    # A streamed reply of `length` chunks, sent every 10 ms
+    def __init__(self, length=200):
+        self.length = length
+        self.sent = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed or self.sent == self.length:
+            raise StopAsyncIteration
+        await asyncio.sleep(0.01)
+        self.sent += 1
+        finish_reason = "stop" if self.sent == self.length else None
+        return {
+            "choices": [{"delta": {"content": "word "}, "finish_reason": finish_reason}]
+        }
+
+    async def aclose(self):
+        self.closed = True
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class StreamChatCompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.streams = []
+
+        async def start(**request):
+            self.streams.append(FakeStream())
+            return self.streams[-1]
+
+        patcher = mock.patch.object(
+            conversation_handlers, "astart_chat_completion", start
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_the_whole_reply(self):
+        chunks = list(stream_chat_completion([{"role": "user", "content": "Hi"}]))
+        self.assertEqual(len(chunks), 200)
+        self.assertEqual(len(self.streams), 1)
+
+    def test_closing_the_consumer_stops_the_producer(self):
+        chunks = stream_chat_completion([{"role": "user", "content": "Hi"}])
+        for _ in range(3):
+            next(chunks)
+        chunks.close()
+        stream = self.streams[0]
+        wait_for(lambda: stream.closed)
+        sent = stream.sent
+        time.sleep(0.2)
+        self.assertEqual(stream.sent, sent)
+        self.assertLess(sent, 200)
+        # Neither retried nor resumed
+        self.assertEqual(len(self.streams), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
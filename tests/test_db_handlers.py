@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+import psycopg2
+import psycopg2.extensions
+
+from db_handlers import ConnectionPool
+
+
+class FakeConnection:
+    # Just enough of a psycopg2 connection for the pool to hand it out
+    def __init__(self, *args, **kwargs):
+        self.closed = 0
+        self.prepared = set()
+        self.last_used = float("inf")
+        self.info = mock.Mock(
+            transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        )
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("psycopg2.connect", side_effect=FakeConnection)
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connects_on_demand(self):
+        ConnectionPool({"dbname": "app"})
+        self.connect.assert_not_called()
+
+    def test_returned_connection_is_reused(self):
+        pool = ConnectionPool({"dbname": "app"})
+        connection = pool.pool.getconn()
+        pool.pool.putconn(connection)
+        self.assertIs(pool.pool.getconn(), connection)
+        self.assertFalse(connection.closed)
+
+    def test_run_reuses_connection_and_prepared_statements(self):
+        pool = ConnectionPool({"dbname": "app"})
+        first = pool.run(lambda connection: connection)
+        first.prepared.add("fetch_system_prompt")
+        second = pool.run(lambda connection: connection)
+        self.assertIs(second, first)
+        self.assertIn("fetch_system_prompt", second.prepared)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_run_discards_connection_whose_rollback_fails(self):
+        pool = ConnectionPool({"dbname": "app"}, max_connections=2)
+
+        def fail(connection):
+            connection.rollback = mock.Mock(side_effect=psycopg2.InterfaceError)
+            raise ValueError("bad statement")
+
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                pool.run(fail)
+        # Every broken connection was closed and its slot given back
+        self.assertEqual(pool.run(lambda connection: "ok"), "ok")
+        self.assertEqual(self.connect.call_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from embedding_handlers import EmbeddingStore
+
+
+def vector(value, dimensions=4):
+    return np.full(dimensions, value, dtype=np.float32)
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def assert_vector(self, store, key, value):
+        np.testing.assert_array_equal(store.get(key), vector(value))
+
+    def test_reload(self):
+        EmbeddingStore(self.directory).put([("a", vector(1)), ("b", vector(2))])
+        store = EmbeddingStore(self.directory)
+        self.assertEqual(len(store), 2)
+        self.assert_vector(store, "b", 2)
+
+    def test_vectors_written_without_their_keys(self):
+        store = EmbeddingStore(self.directory)
+        store.put([("a", vector(1))])
+        # Crash after the vectors were appended, before the keys were
+        with open(store.vectors_path, "ab") as f:
+            f.write(np.asarray([vector(9)], dtype=np.float16).tobytes())
+
+        store = EmbeddingStore(self.directory)
+        store.put([("b", vector(2)), ("c", vector(3))])
+        store = EmbeddingStore(self.directory)
+        self.assert_vector(store, "a", 1)
+        self.assert_vector(store, "b", 2)
+        self.assert_vector(store, "c", 3)
+
+    def test_keys_written_without_their_vectors(self):
+        store = EmbeddingStore(self.directory)
+        store.put([("a", vector(1))])
+        # Crash partway through the vector row, after a key was written
+        with open(store.vectors_path, "ab") as f:
+            f.write(np.asarray([vector(9)], dtype=np.float16).tobytes()[:3])
+        with open(store.keys_path, "a") as f:
+            f.write("x\ny")
+
+        store = EmbeddingStore(self.directory)
+        self.assertEqual(len(store), 1)
+        self.assertIsNone(store.get("x"))
+        store.put([("b", vector(2))])
+        store = EmbeddingStore(self.directory)
+        self.assert_vector(store, "a", 1)
+        self.assert_vector(store, "b", 2)
+        self.assertEqual(os.path.getsize(store.vectors_path), 2 * 4 * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
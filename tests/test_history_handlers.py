@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from functools import partial
+from unittest import mock
+
+import psycopg2
+
+import history_handlers
+from history_handlers import ConversationStore
+
+
+class FakePool:
+    # Runs nothing, records the batches written and fails the ones `fail` picks
+    def __init__(self, fail):
+        self.fail = fail
+        self.written = []
+
+    def run(self, operation):
+        batch = operation.keywords["batch"]
+        error = self.fail(batch)
+        if error is not None:
+            raise error
+        self.written.extend(batch)
+
+
+class GatedPool:
+    # Holds every write until `gate` is set, and reads back what was written
+    def __init__(self):
+        self.gate = threading.Event()
+        self.written = []
+
+    def run(self, operation):
+        if isinstance(operation, partial):
+            self.gate.wait()
+            self.written.extend(operation.keywords["batch"])
+            return None
+        return [
+            (message["role"], None, message["content"], None)
+            for id, _, message in self.written
+        ]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class ConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dead_letters = os.path.join(directory.name, "dead.jsonl")
+        patcher = mock.patch.object(
+            history_handlers, "DEAD_LETTER_FILE", self.dead_letters
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_dead_letters(self):
+        if not os.path.exists(self.dead_letters):
+            return []
+        with open(self.dead_letters) as f:
+            return [json.loads(line) for line in f]
+
+    def test_bad_row_is_set_aside_and_the_rest_written(self):
+        def fail(batch):
+            if any("\x00" in message["content"] for _, _, message in batch):
+                return psycopg2.DataError("invalid byte sequence")
+
+        pool = FakePool(fail)
+        store = ConversationStore(pool)
+        for position, content in enumerate(["hi", "bad\x00", "there"]):
+            store.append("c1", position, {"role": "user", "content": content})
+        wait_for(lambda: len(pool.written) == 2 and self.read_dead_letters())
+
+        self.assertEqual([position for _, position, _ in pool.written], [0, 2])
+        self.assertEqual(
+            [record["position"] for record in self.read_dead_letters()], [1]
+        )
+
+        # The writer keeps going afterwards
+        store.append("c1", 3, {"role": "assistant", "content": "ok"})
+        wait_for(lambda: len(pool.written) == 3)
+
+    def test_connection_errors_are_retried_a_bounded_number_of_times(self):
+        attempts = []
+
+        def fail(batch):
+            attempts.append(batch)
+            return psycopg2.OperationalError("server closed the connection")
+
+        with mock.patch.object(history_handlers, "MAX_WRITE_ATTEMPTS", 3), mock.patch(
+            "history_handlers.time.sleep"
+        ):
+            store = ConversationStore(FakePool(fail))
+            store.append("c1", 0, {"role": "user", "content": "hi"})
+            wait_for(lambda: self.read_dead_letters())
+
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(self.read_dead_letters()[0]["conversation_id"], "c1")
+
+    def test_restore_waits_for_queued_messages(self):
+        pool = GatedPool()
+        store = ConversationStore(pool)
+        for position, content in enumerate(["hi", "there"]):
+            store.append("c1", position, {"role": "user", "content": content})
+        loaded = []
+        restore = threading.Thread(target=lambda: loaded.append(store.load("c1")))
+        restore.start()
+        time.sleep(0.1)
+        self.assertEqual(loaded, [])
+        pool.gate.set()
+        restore.join(5)
+        self.assertEqual([message["content"] for message in loaded[0]], ["hi", "there"])
+
+    def test_restore_gives_up_on_messages_that_stay_queued(self):
+        store = ConversationStore(GatedPool())
+        store.append("c1", 0, {"role": "user", "content": "hi"})
+        with self.assertRaises(TimeoutError):
+            store.load("c1", timeout=0.1)
+        # Other conversations don't wait
+        self.assertEqual(store.load("c2", timeout=0.1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from splitter_handlers import split_tokens
+
+
+class CharEncoding:
+    # One token per character, enough of tiktoken's Encoding for split_tokens
+    def encode_ordinary(self, text):
+        return [ord(character) for character in text]
+
+    def decode(self, tokens):
+        return "".join(chr(token) for token in tokens)
+
+    def decode_single_token_bytes(self, token):
+        return chr(token).encode()
+
+
+class SplitTokensTest(unittest.TestCase):
+    def split(self, *pages, chunk_tokens=40, overlap=12):
+        encoding = CharEncoding()
+        return list(
+            split_tokens(
+                [encoding.encode_ordinary(page) for page in pages],
+                encoding,
+                chunk_tokens=chunk_tokens,
+                overlap=overlap,
+            )
+        )
+
+    def test_chunks_overlap_on_words(self):
+        chunks = self.split(" ".join(f"word{i}" for i in range(30)))
+        self.assertGreater(len(chunks), 1)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertIn(chunk.split()[0], previous.split())
+        self.assertTrue(chunks[-1].endswith("word29"))
+
+    def test_no_tail_chunk_of_overlap_only(self):
+        # The overlap snapped back to a word is longer than `overlap`, and all
+        # that follows the last full chunk is whitespace
+        chunks = self.split(
+            "xx0 xxxxxx1 xxxx2 xxxx3 xxxxxx4 xx5 xxx6 xxxxx7 xxxxxx8 xxxxxx9   "
+        )
+        self.assertEqual(
+            chunks,
+            [
+                "xx0 xxxxxx1 xxxx2 xxxx3 xxxxxx4 xx5 xxx6",
+                "xxxxxx4 xx5 xxx6 xxxxx7 xxxxxx8 xxxxxx9",
+            ],
+        )
+
+    def test_no_tail_chunk_for_an_empty_last_page(self):
+        chunks = self.split(" ".join(f"word{i}" for i in range(9)), "")
+        self.assertNotIn(chunks[-1], chunks[-2])
+
+    def test_short_tail_with_new_text_is_kept(self):
+        chunks = self.split(" ".join(f"word{i}" for i in range(9)), "end")
+        self.assertTrue(chunks[-1].endswith("end"))
+
+    def test_short_document_is_one_chunk(self):
+        self.assertEqual(self.split("just a few words"), ["just a few words"])
+
+
+if __name__ == "__main__":
+    unittest.main()
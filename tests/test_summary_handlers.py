@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+
+import context_handlers
+import summary_handlers
+from context_handlers import count_request_tokens, summary_message
+from summary_handlers import build_summarized_context
+
+
+class WordEncoding:
+    # One token per word, so budgets are easy to reason about
+    def encode(self, text):
+        return text.split()
+
+
+def summarize(summary, messages):
+    return f"{summary or ''} {len(messages)} messages".strip()
+
+
+class BuildSummarizedContextTest(unittest.TestCase):
+    def setUp(self):
+        context_handlers._count_tokens.cache_clear()
+        self.addCleanup(context_handlers._count_tokens.cache_clear)
+        for patcher in [
+            mock.patch.object(
+                context_handlers, "get_encoding", lambda model=None: WordEncoding()
+            ),
+            mock.patch.object(summary_handlers, "summarize", summarize),
+            mock.patch.object(summary_handlers, "RECENT_WINDOW_TOKENS", 500),
+            mock.patch.object(summary_handlers.st, "session_state", {}),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def converse(self, turns):
+        # Builds the context before every reply, like main.py, and lets each
+        # summary job finish before the next turn
+        messages = [{"role": "system", "content": "You are a consultant."}]
+        for turn in range(turns):
+            messages.append({"role": "user", "content": f"question {turn} " * 20})
+            window = build_summarized_context(messages)
+            job = summary_handlers.st.session_state["chat_summary"]["job"]
+            if job is not None:
+                job["future"].result()
+            messages.append({"role": "assistant", "content": f"answer {turn} " * 40})
+        return messages, window
+
+    def test_short_conversation_is_sent_verbatim(self):
+        messages, window = self.converse(3)
+        self.assertEqual(window, messages[:-1])
+        self.assertIsNone(summary_handlers.st.session_state["chat_summary"]["job"])
+
+    def test_long_conversation_gets_a_summary_and_a_short_tail(self):
+        messages, window = self.converse(60)
+        state = summary_handlers.st.session_state["chat_summary"]
+        self.assertEqual(window[0], messages[0])
+        self.assertEqual(window[1], summary_message(state["content"]))
+        self.assertEqual(window[2:], messages[1 + state["summarized"] : -1])
+        # The recent window plus at most one batch still being summarized
+        self.assertLessEqual(
+            len(window[2:]), 500 // 20 + summary_handlers.SUMMARY_BATCH_MESSAGES
+        )
+        self.assertLess(
+            count_request_tokens(window), count_request_tokens(messages) / 5
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
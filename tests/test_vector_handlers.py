@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from vector_handlers import LocalIndex
+
+
+def unit(*values):
+    vector = np.zeros(8, dtype=np.float32)
+    for axis, value in enumerate(values):
+        vector[axis] = value
+    return vector.tolist()
+
+
+class LocalIndexTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def top_ids(self, index, vector, top_k=1):
+        matches = index.query(vector=vector, top_k=top_k, namespace="ns")["matches"]
+        return [match["id"] for match in matches]
+
+    def test_upserts_are_saved_on_flush(self):
+        index = LocalIndex(self.directory)
+        for batch in range(5):
+            index.upsert(
+                [(f"{batch}-{axis}", unit(*[0] * axis, 1)) for axis in range(8)],
+                namespace="ns",
+            )
+        self.assertFalse(os.path.exists(index.path("ns", "vectors.npy")))
+        index.flush()
+
+        index = LocalIndex(self.directory)
+        stats = index.describe_index_stats()
+        self.assertEqual(stats["namespaces"]["ns"]["vector_count"], 40)
+        self.assertEqual(stats["dimension"], 8)
+        self.assertIn(self.top_ids(index, unit(0, 1))[0], {f"{b}-1" for b in range(5)})
+
+    def test_upsert_replaces_existing_id(self):
+        index = LocalIndex(self.directory)
+        index.upsert([("a", unit(1)), ("b", unit(0, 1))], namespace="ns")
+        index.flush()
+        index = LocalIndex(self.directory)
+        # The first write copies the memory-mapped rows
+        index.upsert([("a", unit(0, 0, 1), {"v": 2})], namespace="ns")
+        self.assertEqual(self.top_ids(index, unit(0, 0, 1)), ["a"])
+        self.assertEqual(self.top_ids(index, unit(0, 1)), ["b"])
+        self.assertEqual(len(index.list_ids("ns")), 2)
+        self.assertEqual(
+            index.fetch(["a"], namespace="ns")["vectors"]["a"]["metadata"], {"v": 2}
+        )
+
+    def test_delete_moves_last_row_into_the_gap(self):
+        index = LocalIndex(self.directory)
+        index.upsert(
+            [(name, unit(*[0] * axis, 1)) for axis, name in enumerate("abcd")],
+            namespace="ns",
+        )
+        index.delete(ids=["a", "b", "missing"], namespace="ns")
+        self.assertEqual(sorted(index.list_ids("ns")), ["c", "d"])
+        self.assertEqual(self.top_ids(index, unit(0, 0, 1)), ["c"])
+        self.assertEqual(self.top_ids(index, unit(0, 0, 0, 1)), ["d"])
+        index.flush()
+
+        index = LocalIndex(self.directory)
+        self.assertEqual(self.top_ids(index, unit(0, 0, 0, 1)), ["d"])
+        self.assertEqual(sorted(self.top_ids(index, unit(1), top_k=4)), ["c", "d"])
+
+    def test_delete_all(self):
+        index = LocalIndex(self.directory)
+        index.upsert([("a", unit(1))], namespace="ns")
+        index.flush()
+        index.delete(delete_all=True, namespace="ns")
+        self.assertEqual(
+            LocalIndex(self.directory).describe_index_stats()["namespaces"], {}
+        )
+
+    def test_delete_all_before_flush(self):
+        index = LocalIndex(self.directory)
+        index.upsert([("a", unit(1))], namespace="ns")
+        index.delete(delete_all=True, namespace="ns")
+        self.assertEqual(index.describe_index_stats()["namespaces"], {})
+        index.flush()
+        self.assertEqual(
+            LocalIndex(self.directory).describe_index_stats()["namespaces"], {}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,437 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import lru_cache
+
+import tiktoken
+import streamlit as st
+from langchain.callbacks.base import BaseCallbackHandler
+
+TRACING_ENABLED = st.secrets.get("tracing", {}).get("enabled", True)
+# One finished span per line, appended by every process running the app
+TRACE_FILE = st.secrets.get("tracing", {}).get(
+    "path", os.path.join(".cache", "traces", "spans.jsonl")
+)
+# Past this size the file is moved to TRACE_FILE + ".1", replacing the last one
+TRACE_MAX_BYTES = 20 * 1024 * 1024
+# Spans waiting to be written; past this many they are dropped, not waited on
+MAX_PENDING_SPANS = 10000
+# USD per 1K (prompt, completion) tokens, matched on the longest model prefix
+MODEL_PRICES = {
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+TOKEN_ENCODING = "cl100k_base"
+
+# The span new spans are nested under, per thread and per asyncio task
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name=TOKEN_ENCODING):
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(*texts):
+    # Only for accounting, so a missing encoding never fails the traced call
+    try:
+        encoding = get_encoding()
+    except Exception as e:
+        print("Error=>", e)
+        return None
+    return sum(len(encoding.encode_ordinary(text)) for text in texts if text)
+
+
+def token_cost(model, prompt_tokens, completion_tokens):
+    prefixes = [prefix for prefix in MODEL_PRICES if model.startswith(prefix)]
+    if not prefixes:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[max(prefixes, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class Span:
+    # A timed step of a turn. Spans of one turn share its trace id and point at
+    # their parent, and are exported once they end
+    recording = True
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self.lock:
+            self.attributes.update(attributes)
+
+    def add(self, **counts):
+        with self.lock:
+            for key, count in counts.items():
+                self.attributes[key] = self.attributes.get(key, 0) + count
+
+    def end(self, error=None):
+        with self.lock:
+            if self.end_ns is not None:
+                return
+            self.end_ns = time.time_ns()
+            if error is not None:
+                self.error = error if isinstance(error, str) else repr(error)
+            model = self.attributes.get("model")
+            if model:
+                cost = token_cost(
+                    model,
+                    self.attributes.get("prompt_tokens") or 0,
+                    self.attributes.get("completion_tokens") or 0,
+                )
+                if cost is not None:
+                    self.attributes["cost_usd"] = cost
+        try:
+            get_trace_exporter().export(self.to_dict())
+        except Exception as e:
+            print("Error=>", e)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "attributes": dict(self.attributes),
+            "status": (
+                {"code": "ERROR", "message": self.error}
+                if self.error
+                else {"code": "OK"}
+            ),
+        }
+
+
+class NoopSpan:
+    # Stands in for a span outside of a traced turn, e.g. during ingestion
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, **counts):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def start_trace(name, **attributes):
+    # Root span of a turn, every span started while it is active nests under it
+    if not TRACING_ENABLED:
+        return NOOP_SPAN
+    return Span(name, attributes=attributes)
+
+
+def start_span(name, parent=None, **attributes):
+    parent = parent if parent is not None else current_span.get()
+    if parent is None or not parent.recording:
+        return NOOP_SPAN
+    return Span(name, parent=parent, attributes=attributes)
+
+
+def get_current_span():
+    return current_span.get() or NOOP_SPAN
+
+
+def activate(span):
+    # Returns the token deactivate() needs to restore the previous span
+    return current_span.set(span)
+
+
+def deactivate(token):
+    current_span.reset(token)
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    span = start_span(name, **attributes)
+    token = current_span.set(span if span.recording else current_span.get())
+    try:
+        yield span
+    except BaseException as e:
+        span.end(e)
+        raise
+    finally:
+        current_span.reset(token)
+        span.end()
+
+
+async def in_span(span, coroutine):
+    # Runs `coroutine` nested under `span`, for coroutines handed to the event
+    # loop thread, which doesn't see the caller's current span
+    current_span.set(span)
+    return await coroutine
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    # Turns LangChain runs, i.e. the agent's chains, LLM calls, tools and
+    # retrievers, into spans nested under the span current when it's created.
+    # Streamed LLM calls report no usage, so their tokens are counted here
+    def __init__(self, parent=None):
+        self.parent = parent if parent is not None else get_current_span()
+        self.spans = {}
+
+    def start(self, run_id, parent_run_id, name, **attributes):
+        parent = self.spans.get(parent_run_id, self.parent)
+        self.spans[run_id] = start_span(name, parent=parent, **attributes)
+        return self.spans[run_id]
+
+    def end(self, run_id, error=None, **attributes):
+        span = self.spans.pop(run_id, NOOP_SPAN)
+        span.set(**attributes)
+        span.end(error)
+
+    def on_chain_start(
+        self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self.start(run_id, parent_run_id, f"chain {run_name(serialized)}")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error)
+
+    def on_llm_start(
+        self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self.start(
+            run_id,
+            parent_run_id,
+            "llm",
+            model=llm_model(serialized, kwargs),
+            prompt_tokens=count_tokens(*prompts),
+        )
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self.start(
+            run_id,
+            parent_run_id,
+            "llm",
+            model=llm_model(serialized, kwargs),
+            prompt_tokens=count_tokens(
+                *[message.content for batch in messages for message in batch]
+            ),
+        )
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        self.spans.get(run_id, NOOP_SPAN).add(completion_tokens=1)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        span = self.spans.get(run_id, NOOP_SPAN)
+        if usage:
+            span.set(
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+            )
+        elif span.recording and "completion_tokens" not in span.attributes:
+            span.set(
+                completion_tokens=count_tokens(
+                    *[
+                        generation.text
+                        for generations in response.generations
+                        for generation in generations
+                    ]
+                )
+            )
+        self.end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error)
+
+    def on_tool_start(
+        self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self.start(run_id, parent_run_id, f"tool {run_name(serialized)}")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self.end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error)
+
+    def on_retriever_start(
+        self, serialized, query, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self.start(run_id, parent_run_id, "retriever")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self.end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error)
+
+
+def run_name(serialized):
+    serialized = serialized or {}
+    if serialized.get("name"):
+        return serialized["name"]
+    return (serialized.get("id") or ["run"])[-1]
+
+
+def llm_model(serialized, kwargs):
+    params = kwargs.get("invocation_params") or (serialized or {}).get("kwargs") or {}
+    return params.get("model_name") or params.get("model") or ""
+
+
+class TraceExporter:
+    # Write-behind JSONL exporter: ending a span only queues it, a writer
+    # thread appends whatever has queued up to the file. Spans lost on the way
+    # are counted, pages/traces.py shows the counts
+    def __init__(self, path=TRACE_FILE, max_bytes=TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pending = queue.Queue(maxsize=MAX_PENDING_SPANS)
+        # Spans dropped with the buffer full, and spans in failed writes
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        threading.Thread(target=self.write_behind, daemon=True).start()
+
+    def export(self, span):
+        try:
+            self.pending.put_nowait(span)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # Once per thousand, the buffer stays full while the writer is stuck
+            if dropped % 1000 == 1:
+                print(f"Error=> trace buffer is full, {dropped} spans dropped so far")
+
+    def write_behind(self):
+        while True:
+            batch = [self.pending.get()]
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                with self.lock:
+                    self.failed += len(batch)
+                print(f"Error=> unable to write {len(batch)} spans:", e)
+
+    def write(self, batch):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(span, default=str) + "\n" for span in batch))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending.qsize(),
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
+
+
+# No spinner: spans also end on worker threads and the shared event loop,
+# where there's no script run to draw one and the lookup would raise
+@st.cache_resource(show_spinner=False)
+def get_trace_exporter():
+    return TraceExporter()
+
+
+def load_traces(path=TRACE_FILE, limit=50):
+    # The last `limit` traces as lists of span dicts, oldest first
+    traces = {}
+    for file_path in [path + ".1", path]:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # A line still being written by another process
+                    continue
+                traces.setdefault(span["trace_id"], []).append(span)
+    ordered = sorted(
+        traces.values(),
+        key=lambda spans: min(span["start_time_unix_nano"] for span in spans),
+    )
+    return ordered[-limit:]
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans, service_name="chatgpt-clone"):
+    # OTLP/JSON ExportTraceServiceRequest, accepted by collectors' otlp
+    # receivers and by most tracing UIs' file import
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": otlp_value(service_name)}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "trace_handlers"},
+                        "spans": [
+                            {
+                                "traceId": span["trace_id"],
+                                "spanId": span["span_id"],
+                                "parentSpanId": span["parent_span_id"] or "",
+                                "name": span["name"],
+                                "kind": 1,
+                                "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                                "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                                "attributes": [
+                                    {"key": key, "value": otlp_value(value)}
+                                    for key, value in span["attributes"].items()
+                                    if value is not None
+                                ],
+                                "status": (
+                                    {"code": 2, "message": span["status"]["message"]}
+                                    if span["status"]["code"] == "ERROR"
+                                    else {"code": 1}
+                                ),
+                            }
+                            for span in spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
@@ -0,0 +1,410 @@
+import os
+import json
+import uuid
+import atexit
+import threading
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pinecone
+import streamlit as st
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+
+from startup_handlers import timed_resource
+from trace_handlers import trace_span
+
+# "pinecone" uses the hosted index, "local" an in-process NumPy index on disk
+VECTOR_BACKEND = st.secrets.get("vector_store", {}).get("backend", "pinecone")
+LOCAL_INDEX_DIR = st.secrets.get("vector_store", {}).get(
+    "path", os.path.join(".cache", "vector_index")
+)
+# Rows a namespace's buffer starts with, it doubles whenever it fills up
+LOCAL_INDEX_MIN_CAPACITY = 1024
+
+
+class LocalIndex:
+    # In-process stand-in for pinecone.Index with the subset of its API the app
+    # uses. Each namespace is a matrix of unit vectors saved as vectors.npy and
+    # memory-mapped on load, next to records.json holding ids and metadata.
+    # Queries are a single matrix-vector product, so cosine top-k over a few
+    # thousand chunks takes well under a millisecond.
+    #
+    # Upserts and deletes only change memory: rows go into a buffer that grows
+    # geometrically, so an ingestion of many batches copies each row a bounded
+    # number of times. Changed namespaces are written by flush(), which writers
+    # call once they're done, e.g. at the end of an ingestion
+    def __init__(self, directory=LOCAL_INDEX_DIR):
+        self.directory = directory
+        self.namespaces = {}
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if os.path.exists(os.path.join(directory, name, "records.json")):
+                self.load(unquote(name))
+
+    def path(self, namespace, file_name=""):
+        return os.path.join(self.directory, quote(namespace, safe=""), file_name)
+
+    def load(self, namespace):
+        with open(self.path(namespace, "records.json")) as f:
+            records = json.load(f)
+        matrix = np.load(self.path(namespace, "vectors.npy"), mmap_mode="r")
+        self.namespaces[namespace] = {
+            # Read-only until the first write copies it into memory
+            "buffer": matrix,
+            "matrix": matrix,
+            "ids": [record["id"] for record in records],
+            "metadata": [record["metadata"] for record in records],
+            "rows": {record["id"]: row for row, record in enumerate(records)},
+            "dirty": False,
+        }
+
+    def save(self, namespace):
+        data = self.namespaces[namespace]
+        os.makedirs(self.path(namespace), exist_ok=True)
+        # Write then rename, so readers still mapping the old file are unaffected
+        vectors_path = self.path(namespace, "vectors.npy")
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(data["matrix"]))
+        os.replace(vectors_path + ".tmp", vectors_path)
+        records_path = self.path(namespace, "records.json")
+        with open(records_path + ".tmp", "w") as f:
+            json.dump(
+                [
+                    {"id": id, "metadata": metadata}
+                    for id, metadata in zip(data["ids"], data["metadata"])
+                ],
+                f,
+            )
+        os.replace(records_path + ".tmp", records_path)
+
+    def flush(self, namespace=None):
+        # Saves the namespaces changed since the last flush, or just `namespace`
+        with self.lock:
+            names = list(self.namespaces) if namespace is None else [namespace]
+            for name in names:
+                data = self.namespaces.get(name)
+                if data is not None and data["dirty"]:
+                    self.save(name)
+                    data["dirty"] = False
+
+    def list_ids(self, namespace=""):
+        with self.lock:
+            data = self.namespaces.get(namespace)
+            return list(data["ids"]) if data is not None else []
+
+    @staticmethod
+    def writable(data, rows, dimensions):
+        # The namespace's buffer, with room for `rows` rows and writable
+        buffer = data["buffer"]
+        if buffer is not None and buffer.flags.writeable and len(buffer) >= rows:
+            return buffer
+        count = len(data["ids"])
+        capacity = max(
+            rows,
+            2 * len(buffer) if buffer is not None else 0,
+            LOCAL_INDEX_MIN_CAPACITY,
+        )
+        grown = np.empty((capacity, dimensions), dtype=np.float32)
+        if buffer is not None:
+            grown[:count] = buffer[:count]
+        data["buffer"] = grown
+        return grown
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def upsert(self, vectors, namespace="", **kwargs):
+        records = [
+            (
+                (item["id"], item["values"], item.get("metadata", {}))
+                if isinstance(item, dict)
+                else (item[0], item[1], item[2] if len(item) > 2 else {})
+            )
+            for item in vectors
+        ]
+        if not records:
+            return {"upserted_count": 0}
+        vectors = self.normalize([values for _, values, _ in records])
+        with self.lock:
+            data = self.namespaces.get(namespace)
+            if data is None:
+                data = {
+                    "buffer": None,
+                    "matrix": None,
+                    "ids": [],
+                    "metadata": [],
+                    "rows": {},
+                    "dirty": False,
+                }
+                self.namespaces[namespace] = data
+            added = len({id for id, _, _ in records if id not in data["rows"]})
+            buffer = self.writable(data, len(data["ids"]) + added, vectors.shape[1])
+            for (id, _, metadata), vector in zip(records, vectors):
+                row = data["rows"].get(id)
+                if row is None:
+                    row = len(data["ids"])
+                    data["rows"][id] = row
+                    data["ids"].append(id)
+                    data["metadata"].append(metadata)
+                else:
+                    data["metadata"][row] = metadata
+                buffer[row] = vector
+            data["matrix"] = buffer[: len(data["ids"])]
+            data["dirty"] = True
+        return {"upserted_count": len(records)}
+
+    @staticmethod
+    def matches_filter(metadata, filter):
+        # Equality filters only, e.g. {"source": "fdd.pdf"}
+        for key, condition in filter.items():
+            expected = (
+                condition.get("$eq") if isinstance(condition, dict) else condition
+            )
+            if metadata.get(key) != expected:
+                return False
+        return True
+
+    def query(
+        self,
+        vector=None,
+        top_k=10,
+        namespace="",
+        include_metadata=False,
+        include_values=False,
+        filter=None,
+        **kwargs,
+    ):
+        # Scored under the lock, as upserts and deletes change rows in place
+        with self.lock:
+            data = self.namespaces.get(namespace)
+            if data is None or data["matrix"] is None or not data["ids"]:
+                return {"matches": [], "namespace": namespace}
+            matrix, ids, metadata = data["matrix"], data["ids"], data["metadata"]
+            scores = np.asarray(matrix @ self.normalize(vector))
+            if filter:
+                allowed = np.array(
+                    [self.matches_filter(item, filter) for item in metadata],
+                    dtype=bool,
+                )
+                scores = np.where(allowed, scores, -np.inf)
+            top_k = min(top_k, len(scores))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+            matches = []
+            for row in top:
+                if not np.isfinite(scores[row]):
+                    continue
+                match = {"id": ids[row], "score": float(scores[row])}
+                if include_metadata:
+                    match["metadata"] = dict(metadata[row])
+                if include_values:
+                    match["values"] = matrix[row].tolist()
+                matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids, namespace="", **kwargs):
+        with self.lock:
+            data = self.namespaces.get(namespace)
+            if data is None:
+                return {"vectors": {}, "namespace": namespace}
+            rows = [(id, data["rows"][id]) for id in ids if id in data["rows"]]
+            vectors = {
+                id: {
+                    "id": id,
+                    "values": data["matrix"][row].tolist(),
+                    "metadata": dict(data["metadata"][row]),
+                }
+                for id, row in rows
+            }
+        return {"vectors": vectors, "namespace": namespace}
+
+    def delete(self, ids=None, delete_all=False, namespace="", **kwargs):
+        with self.lock:
+            data = self.namespaces.get(namespace)
+            if data is None:
+                return {}
+            if delete_all:
+                del self.namespaces[namespace]
+                for file_name in ["vectors.npy", "records.json"]:
+                    if os.path.exists(self.path(namespace, file_name)):
+                        os.remove(self.path(namespace, file_name))
+                # A namespace that was never flushed has no directory yet
+                if os.path.isdir(self.path(namespace)):
+                    os.rmdir(self.path(namespace))
+                return {}
+            drop = [id for id in set(ids or []) if id in data["rows"]]
+            if not drop:
+                return {}
+            buffer = self.writable(data, len(data["ids"]), data["matrix"].shape[1])
+            # The last row moves into each deleted one, so a delete costs the
+            # rows it removes rather than the whole namespace
+            for id in drop:
+                row = data["rows"].pop(id)
+                last = len(data["ids"]) - 1
+                if row != last:
+                    moved = data["ids"][last]
+                    buffer[row] = buffer[last]
+                    data["ids"][row] = moved
+                    data["metadata"][row] = data["metadata"][last]
+                    data["rows"][moved] = row
+                data["ids"].pop()
+                data["metadata"].pop()
+            data["matrix"] = buffer[: len(data["ids"])]
+            data["dirty"] = True
+        return {}
+
+    def describe_index_stats(self, **kwargs):
+        with self.lock:
+            namespaces = {
+                namespace: {"vector_count": len(data["ids"])}
+                for namespace, data in self.namespaces.items()
+            }
+            dimension = next(
+                (
+                    data["matrix"].shape[1]
+                    for data in self.namespaces.values()
+                    if data["matrix"] is not None
+                ),
+                0,
+            )
+        return {
+            "namespaces": namespaces,
+            "dimension": dimension,
+            "total_vector_count": sum(
+                stats["vector_count"] for stats in namespaces.values()
+            ),
+        }
+
+
+class IndexVectorStore(VectorStore):
+    # LangChain vector store over any index with pinecone.Index's API, so the
+    # app works the same against Pinecone and LocalIndex. Chunk text is kept
+    # under metadata["text"], like langchain's Pinecone store, so existing
+    # namespaces stay readable
+    def __init__(self, index, embedding, namespace=None, text_key="text"):
+        self.index = index
+        self.embedding = embedding
+        self.namespace = namespace
+        self.text_key = text_key
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def add_texts(
+        self, texts, metadatas=None, ids=None, namespace=None, batch_size=32, **kwargs
+    ):
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start : start + batch_size]
+            self.add_embeddings(
+                batch,
+                self.embedding.embed_documents(batch),
+                metadatas=metadatas[start : start + batch_size],
+                ids=ids[start : start + batch_size],
+                namespace=namespace,
+            )
+        return ids
+
+    def add_embeddings(
+        self, texts, vectors, metadatas=None, ids=None, namespace=None, **kwargs
+    ):
+        # Upserts texts that were already embedded, e.g. by the ingestion workers
+        namespace = namespace if namespace is not None else self.namespace
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        self.index.upsert(
+            vectors=[
+                (id, vector, {**metadata, self.text_key: text})
+                for id, vector, metadata, text in zip(ids, vectors, metadatas, texts)
+            ],
+            namespace=namespace,
+        )
+        return ids
+
+    def similarity_search_by_vector_with_score(
+        self, embedding, k=4, filter=None, namespace=None, **kwargs
+    ):
+        namespace = namespace if namespace is not None else self.namespace
+        with trace_span("vector_query", namespace=namespace, top_k=k) as span:
+            results = self.index.query(
+                vector=list(embedding),
+                top_k=k,
+                namespace=namespace,
+                include_metadata=True,
+                filter=filter,
+            )
+            span.set(matches=len(results["matches"]))
+        documents = []
+        for match in results["matches"]:
+            metadata = dict(match["metadata"])
+            text = metadata.pop(self.text_key, "")
+            documents.append(
+                (Document(page_content=text, metadata=metadata), match["score"])
+            )
+        return documents
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(
+            self.embedding.embed_query(query), k=k, **kwargs
+        )
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(query, k=k, **kwargs)
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [
+            document
+            for document, _ in self.similarity_search_by_vector_with_score(
+                embedding, k=k, **kwargs
+            )
+        ]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts,
+        embedding,
+        metadatas=None,
+        ids=None,
+        index=None,
+        namespace=None,
+        batch_size=32,
+        **kwargs,
+    ):
+        vector_store = cls(index or get_vector_index(), embedding, namespace=namespace)
+        vector_store.add_texts(
+            texts, metadatas=metadatas, ids=ids, batch_size=batch_size
+        )
+        # Pinecone has nothing to flush, LocalIndex saves the namespace
+        flush = getattr(vector_store.index, "flush", None)
+        if flush is not None:
+            flush(vector_store.namespace)
+        return vector_store
+
+
+@st.cache_resource
+@timed_resource("vector_index")
+def get_vector_index():
+    if VECTOR_BACKEND == "local":
+        print("loading local vector index...")
+        index = LocalIndex()
+        # Changes made outside an ingestion, if any, are saved on shutdown
+        atexit.register(index.flush)
+        return index
+    print("connecting to pinecone...")
+    pinecone.init(
+        api_key=st.secrets["pinecone"]["api_key"],
+        environment=st.secrets["pinecone"]["env"],
+    )
+    return pinecone.Index(st.secrets["pinecone"]["index_name"])